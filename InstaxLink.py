@@ -6,7 +6,25 @@ from struct import pack, unpack_from
 from enum import Enum
 import io
 import os
+import random
+import mmap
+from contextlib import contextmanager, redirect_stdout
+import itertools
+import json
+import uuid
+import time
+import tempfile
+import platform
+import cProfile
+import pstats
+from collections import OrderedDict, deque
+from http import HTTPStatus
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
+try:
+    import numpy as np
+except ImportError:
+    np = None
 from bleak import BleakScanner, BleakClient
 import bluetooth
 
@@ -168,6 +186,11 @@ class AutoSleepSettingsMode(Enum):
     SET_PROVITIONAL_SLEEP_SETTING = 4
     SET_DEFAULT_SLEEP_SETTING = 5
 
+class BulkUploadType(Enum):
+    PRINT_IMAGE = SID.PRINT_IMAGE_DOWNLOAD_START, SID.PRINT_IMAGE_DOWNLOAD_DATA, SID.PRINT_IMAGE_DOWNLOAD_END
+    FIRMWARE = SID.FW_DOWNLOAD_START, SID.FW_DOWNLOAD_DATA, SID.FW_DOWNLOAD_END
+    FRAME_PICTURE = SID.FRAME_PICTURE_DOWNLOAD_START, SID.FRAME_PICTURE_DOWNLOAD, SID.FRAME_PICTURE_DOWNLOAD_END
+
 class PrinterMountedHeadType(Enum):
     FUTABA = 0
     TOHOKU = 1
@@ -178,31 +201,118 @@ class PrinterMountedHeadType(Enum):
 def isKthBitSet(byte, pos):
     return ((1 << pos) & byte) >= 1
 
-def slice_image(imageByteArray, frameSize):
-    frames = list()
-    frame = b''
-    for i in range(len(imageByteArray)):
-        frame += pack('>B', imageByteArray[i])
-        if (i + 1) % frameSize == 0:
-            frames.append(frame)
-            frame = b''
-        elif i == len(imageByteArray) - 1:
-            # pad the last slice with x00
-            for j in range(frameSize - len(frame)):
-                frame += b'\x00'
-            frames.append(frame)
-    return frames
+def slice_frame(imageBuffer, frameSize, frameNumber):
+    # frames are sliced on demand, so a memory mapped file is never read as a whole
+    frame = imageBuffer[frameNumber * frameSize:(frameNumber + 1) * frameSize]
+    if len(frame) < frameSize:
+        # pad the last slice with x00
+        frame += b'\x00' * (frameSize - len(frame))
+    return frame
+
+@contextmanager
+def map_image(imagePath):
+    with open(imagePath, 'rb') as image:
+        with mmap.mmap(image.fileno(), 0, access = mmap.ACCESS_READ) as imageBuffer:
+            yield imageBuffer
+
+# Color
+
+cubeLutCache = {} # (path, modification time) -> CubeLUT
+
+class CubeLUT():
+    __slots__ = ('title', 'size', 'domainMin', 'domainMax', 'table')
+
+    def __init__(self, title, size, domainMin, domainMax, table):
+        self.title = title
+        self.size = size # points per axis
+        self.domainMin = domainMin # numpy array, r g b
+        self.domainMax = domainMax # numpy array, r g b
+        self.table = table # numpy array size^3 x 3, red index varying fastest
+
+    def __str__(self):
+        return f'Title: {self.title}, size: {self.size}, domain min: {self.domainMin}, domain max: {self.domainMax}'
+
+    def apply(self, pixels): # numpy array height x width x 3 of uint8
+        n = self.size
+        # 8 bit input only has 256 levels per channel, so lattice indices and weights are looked up instead of computed per pixel
+        levels = (np.arange(256, dtype = np.float32)[:, None] / 255 - self.domainMin) / (self.domainMax - self.domainMin) * (n - 1)
+        np.clip(levels, 0, n - 1, out = levels)
+        lowerLevels = np.minimum(levels.astype(np.intp), n - 2)
+        weightLevels = levels - lowerLevels.astype(np.float32)
+        flat = pixels.reshape(-1, 3)
+        base = np.take(lowerLevels[:, 0], flat[:, 0]) + np.take(lowerLevels[:, 1] * n, flat[:, 1]) + np.take(lowerLevels[:, 2] * n * n, flat[:, 2])
+        weights = [np.take(weightLevels[:, channel], flat[:, channel])[:, None] for channel in range(3)]
+        # successive linear interpolations along r, g and b between the 8 surrounding lattice points
+        corners = [np.take(self.table, base + offset, axis = 0) for offset in (0, 1, n, n + 1, n * n, n * n + 1, n * n + n, n * n + n + 1)]
+        for weight in weights:
+            for k in range(0, len(corners), 2):
+                lower, upper = corners[k], corners[k + 1]
+                upper -= lower
+                upper *= weight
+                lower += upper
+            corners = corners[::2]
+        result = corners[0]
+        result *= 255
+        result += 0.5
+        np.clip(result, 0, 255, out = result)
+        return result.astype(np.uint8).reshape(pixels.shape)
+
+def parse_cube_lut(text):
+    title = ''
+    size = 0
+    domainMin = [0.0, 0.0, 0.0]
+    domainMax = [1.0, 1.0, 1.0]
+    values = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split(None, 1) # keywords may be followed by tabs as well as spaces
+        keyword, value = fields[0], fields[1] if len(fields) > 1 else ''
+        if keyword in ('LUT_3D_SIZE', 'DOMAIN_MIN', 'DOMAIN_MAX') and not value:
+            raise Exception("Invalid LUT, %s has no value" % keyword)
+        if keyword == 'TITLE':
+            title = value.strip().strip('"')
+        elif keyword == 'LUT_3D_SIZE':
+            size = int(value)
+        elif keyword == 'DOMAIN_MIN':
+            domainMin = [float(v) for v in value.split()]
+        elif keyword == 'DOMAIN_MAX':
+            domainMax = [float(v) for v in value.split()]
+        elif keyword == 'LUT_1D_SIZE':
+            raise Exception("1D LUTs are not supported")
+        elif keyword[0].isalpha():
+            continue # other keywords, e.g. LUT_3D_INPUT_RANGE, are ignored
+        else:
+            values.append(line)
+    table = np.array(' '.join(values).split(), dtype = np.float32).reshape(-1, 3)
+    if size < 2 or len(table) != size ** 3:
+        raise Exception("Invalid LUT, expected %i entries and found %i" % (size ** 3, len(table)))
+    return CubeLUT(title, size, np.array(domainMin, dtype = np.float32), np.array(domainMax, dtype = np.float32), table)
+
+def load_cube_lut(path):
+    if np is None:
+        raise Exception("numpy is required to apply a LUT")
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    if key not in cubeLutCache:
+        with open(path) as file:
+            cubeLutCache[key] = parse_cube_lut(file.read())
+    return cubeLutCache[key]
+
+headCalibrationCache = {} # printer serial -> LightCorrectInfoResponse
+
+def head_compensation_table(calibration, reference): # LightCorrectInfoResponse, (r, g, b) reference intensities
+    # each channel is scaled by reference / measured intensity, as a 768 entries table for Image.point
+    table = []
+    for intensity, target in zip((calibration.rIntensity, calibration.gIntensity, calibration.bIntensity), reference):
+        gain = target / intensity if intensity else 1.0
+        table.extend(min(255, int(value * gain + 0.5)) for value in range(256))
+    return table
 
 # Messages
 
 class Message:
-    def __init__(self, signature, sid, data, resultCode = ResultCode.UNKNOWN, size = 0, checksum = 0):
-        self.signature = signature # 2 chars
-        self.size = size # unsigned short
-        self.sid = sid # (unsigned char, unsigned char)
-        self.resultCode = resultCode # unsigned char, only InboundMessage
-        self.data = data # bytearray
-        self.checksum = checksum # unsigned char
+    __slots__ = ()
 
     def __str__(self):
         return f'Signature: {self.signature.decode()}, size: {self.size}, SID: {self.sid.name}, result code: {self.resultCode.name}, data: {self.data.hex(" ", 1)}, checksum: {self.checksum}'
@@ -214,10 +324,15 @@ class Message:
         return (255 - (sum(self.get_content()) & 255)) & 255
 
 class OutboundMessage(Message):
+    __slots__ = ('signature', 'size', 'sid', 'resultCode', 'data', 'checksum')
+
     def __init__(self, sid, data):
-        super().__init__(b'\x41\x62', sid, data)
-        self.size = self.calculate_size(data)
-        self.checksum = self.calculate_checksum()
+        self.signature = b'\x41\x62' # 2 chars
+        self.sid = sid # (unsigned char, unsigned char)
+        self.resultCode = ResultCode.UNKNOWN # only InboundMessage
+        self.data = data # bytearray
+        self.size = self.calculate_size(data) # unsigned short
+        self.checksum = self.calculate_checksum() # unsigned char
     
     def calculate_size(self, bytearray):
         return 7 + len(bytearray)
@@ -226,9 +341,55 @@ class OutboundMessage(Message):
         return self.get_content() + pack('>B', self.checksum)
 
 class InboundMessage(Message):
-    def __init__(self, signature, size, sid, resultCode, data, checksum):
-        super().__init__(signature, sid, data, resultCode, size, checksum)
+    __slots__ = ('payload',)
+
+    def __init__(self, payload):
+        self.payload = payload # bytearray, fields are decoded from it on access
+
+    @classmethod
+    def build(cls, sid, resultCode, data): # SID, ResultCode, bytearray
+        content = b'\x61\x42' + pack('>HBBB', 8 + len(data), sid.value[0], sid.value[1], resultCode.value) + data
+        return cls(content + pack('>B', (255 - (sum(content) & 255)) & 255))
+
+    @property
+    def signature(self):
+        return self.payload[:2]
+
+    @property
+    def size(self):
+        return unpack_from('>H', self.payload, 2)[0]
+
+    @property
+    def sid(self):
+        return SID((self.payload[4], self.payload[5]))
+
+    @property
+    def resultCode(self):
+        return ResultCode(self.payload[6])
+
+    @property
+    def data(self):
+        return self.payload[7:-1]
+
+    @property
+    def checksum(self):
+        return self.payload[self.size - 1]
+
+    def __str__(self):
+        # the fields of a truncated or corrupted payload may not decode, it's shown as is
+        if not self.validate_size():
+            return f'Payload: {bytes(self.payload).hex(" ", 1)}'
+        try:
+            return super().__str__()
+        except ValueError: # unknown SID or result code, or a signature that isn't text
+            return f'Payload: {bytes(self.payload).hex(" ", 1)}'
+
+    def get_content(self):
+        return self.payload[:-1]
     
+    def validate_size(self):
+        return len(self.payload) >= 8 and self.size == len(self.payload)
+
     def validate_signature(self):
         return self.signature == b'\x61\x42'
     
@@ -273,14 +434,32 @@ class ImageTransferStartRequest(Request):
         data = pack('>BBBBI', pictureType.value[0], picturePrintOption.value, 0, 0, imageSize)
         super().__init__(SID.PRINT_IMAGE_DOWNLOAD_START, data)
 
-class ImageFrameTransferRequest(Request):
+class UploadStartRequest(Request):
+    def __init__(self, uploadType, size): # BulkUploadType, unsigned int
+        # the start payload of firmware and frame picture uploads is assumed to be the bare size, this hasn't been verified on a device
+        data = pack('>I', size)
+        super().__init__(uploadType.value[0], data)
+
+class UploadFrameRequest(Request):
+    def __init__(self, uploadType, frameNumber, frameData): # BulkUploadType, unsigned int, bytearray
+        data = pack('>I', frameNumber) + frameData
+        super().__init__(uploadType.value[1], data)
+
+class UploadEndRequest(Request):
+    def __init__(self, uploadType): # BulkUploadType
+        super().__init__(uploadType.value[2])
+
+class ImageFrameTransferRequest(UploadFrameRequest):
     def __init__(self, frameNumber, imageFrameData): # unsigned int, bytearray
-        data = pack('>I', frameNumber) + imageFrameData
-        super().__init__(SID.PRINT_IMAGE_DOWNLOAD_DATA, data)
+        super().__init__(BulkUploadType.PRINT_IMAGE, frameNumber, imageFrameData)
 
-class ImageTransferEndRequest(Request):
+class ImageTransferEndRequest(UploadEndRequest):
     def __init__(self):
-        super().__init__(SID.PRINT_IMAGE_DOWNLOAD_END)
+        super().__init__(BulkUploadType.PRINT_IMAGE)
+
+class ImageTransferCancelRequest(Request):
+    def __init__(self):
+        super().__init__(SID.PRINT_IMAGE_DOWNLOAD_CANCEL)
 
 class ImagePrintRequest(Request):
     def __init__(self):
@@ -292,22 +471,33 @@ class LightCorrectInfoRequest(Request):
 
 # Responses
 
+class InstaxResultError(Exception):
+    def __init__(self, resultCode): # ResultCode
+        super().__init__("Printer replied with error code %s" % resultCode.name)
+        self.resultCode = resultCode
+
 class Response:
+    __slots__ = ('message', 'valid')
+
     def __init__(self, payload):
         self.message = self.parse(payload) # bytearray -> InboundMessage
         self.valid = self.validate()
 
     def __str__(self):
-        return f'SID: {self.message.sid.name}, result code: {self.message.resultCode.name}, data: {self.message.data.hex(" ", 1)}'
+        if not self.message.validate_size():
+            return f'Invalid payload: {bytes(self.message.payload).hex(" ", 1)}'
+        try:
+            return f'SID: {self.message.sid.name}, result code: {self.message.resultCode.name}, data: {self.message.data.hex(" ", 1)}'
+        except ValueError: # unknown SID or result code
+            return f'Invalid payload: {bytes(self.message.payload).hex(" ", 1)}'
     
     def parse(self, payload):
-        signature, size, modeCode, typeCode, resultCode = unpack_from('>2sHBBB', payload)
-        data = payload[7:-1]
-        checksum, = unpack_from('>B', payload, size-1)
-        return InboundMessage(signature, size, SID((modeCode, typeCode)), ResultCode(resultCode), data, checksum)
+        return InboundMessage(payload)
     
     def validate(self):
-        if self.message.validate_signature():
+        if not self.message.validate_size():
+            print('Invalid size!')
+        elif self.message.validate_signature():
             if self.message.validate_checksum():
                 if self.message.resultCode == ResultCode.OK:
                     return True
@@ -320,6 +510,8 @@ class Response:
         return False
 
 class SupportFunctionaAndVersionInfoResponse():
+    __slots__ = ('supportFunctionInfo', 'deviceInfoVersion', 'supportImgInfoVersion', 'batteryInfoVersion', 'printerFuncInfoVersion', 'printerHistoryInfoVersion', 'cameraFuncInfoVersion', 'cameraHistoryInfoVersion')
+
     def __init__(self, data):
         self.supportFunctionInfo, self.deviceInfoVersion, self.supportImgInfoVersion, self.batteryInfoVersion, self.printerFuncInfoVersion, self.printerHistoryInfoVersion, self.cameraFuncInfoVersion, self.cameraHistoryInfoVersion = unpack_from('>BBBBBBBB', data)
     
@@ -342,17 +534,24 @@ class SupportFunctionaAndVersionInfoResponse():
         return isKthBitSet(self.supportFunctionInfo, 0)
 
 class DeviceInfoResponse():
+    __slots__ = ('type', 'rawValue')
+
     def __init__(self, data):
         type, = unpack_from('>B', data)
         self.type = DeviceInfoType(type)
         valueSize, = unpack_from('>B', data, 1)
-        value, = unpack_from('>%is' % valueSize, data, 2)
-        self.value = value.decode()
+        self.rawValue, = unpack_from('>%is' % valueSize, data, 2)
+
+    @property
+    def value(self):
+        return self.rawValue.decode()
 
     def __str__(self):
         return f'Device info type: {self.type.name}, value: {self.value}'
 
 class ImageSupportInfo():
+    __slots__ = ('width', 'height', 'picType', 'picOption', 'size')
+
     def __init__(self, width, height, picType, picOption, size):
         self.width = width # unsigned short
         self.height = height # unsigned short
@@ -367,6 +566,8 @@ class ImageSupportInfo():
         return isKthBitSet(self.picOption, 3)
 
 class BatteryInfo():
+    __slots__ = ('batteryCapacity', 'batteryLevel', 'chargerState', 'chargerType')
+
     def __init__(self, batteryLevel, batteryCapacity, chargerType, chargerState):
         self.batteryCapacity = batteryCapacity # unsigned char
         self.batteryLevel = batteryLevel # unsigned char
@@ -384,30 +585,53 @@ class BatteryInfo():
             return False
 
 class PrinterFunctionInfo():
+    __slots__ = ('filmData', 'statusData', 'resultData', 'printWaitTime', 'printerErrType')
+
     def __init__(self, filmData, statusData, resultData, printWaitTime, errorData):
-        self.backCoverState, self.printerOperationFlg, self.printerErrFlg, self.printerOperationInfo = self.setStatusData(statusData) # unsigned char
-        self.filmRemain, self.batteryRemain, self.chargeFlg = self.setFilmData(filmData) # unsigned char
+        self.filmData = filmData # unsigned char
+        self.statusData = statusData # unsigned char
+        self.resultData = resultData # unsigned char
         self.printWaitTime = printWaitTime # unsigned char
         self.printerErrType = errorData # int
-        self.resultPrintRequest = PrinterResults(resultData) # PrinterResults
 
     def __str__(self):
         return f'Back cover open: {self.backCoverState}, battery remain: {self.batteryRemain}, charge flag: {self.chargeFlg}, film remain: {self.filmRemain}, print wait time: {self.printWaitTime}, printer error flag: {self.printerErrFlg}, printer error type: {self.printerErrType}, printer operation flag: {self.printerOperationFlg}, printer operation info: {self.printerOperationInfo}, result print request: {self.resultPrintRequest.name}'
     
-    def setFilmData(self, byte):
-        filmRemain = byte & 15
-        batteryRemain = (byte >> 4) & 7
-        chargeFlg = isKthBitSet(byte, 7)
-        return filmRemain, batteryRemain, chargeFlg
-    
-    def setStatusData(self, byte):
-        backCoverState = isKthBitSet(byte, 0)
-        printerOperationFlg = isKthBitSet(byte, 1)
-        printerErrFlg = isKthBitSet(byte, 2)
-        printerOperationInfo = (byte >> 4) & 15
-        return backCoverState, printerOperationFlg, printerErrFlg, printerOperationInfo
+    @property
+    def filmRemain(self):
+        return self.filmData & 15
+
+    @property
+    def batteryRemain(self):
+        return (self.filmData >> 4) & 7
+
+    @property
+    def chargeFlg(self):
+        return isKthBitSet(self.filmData, 7)
+
+    @property
+    def backCoverState(self):
+        return isKthBitSet(self.statusData, 0)
+
+    @property
+    def printerOperationFlg(self):
+        return isKthBitSet(self.statusData, 1)
+
+    @property
+    def printerErrFlg(self):
+        return isKthBitSet(self.statusData, 2)
+
+    @property
+    def printerOperationInfo(self):
+        return (self.statusData >> 4) & 15
+
+    @property
+    def resultPrintRequest(self):
+        return PrinterResults(self.resultData)
 
 class PrintHistoryInfo():
+    __slots__ = ('totalPrintNum', 'totalEjectFCNum')
+
     def __init__(self, totalPrintNum, totalEjectFCNum):
         self.totalPrintNum = totalPrintNum # int
         self.totalEjectFCNum = totalEjectFCNum # int
@@ -416,6 +640,8 @@ class PrintHistoryInfo():
         return f'Total number of prints: {self.totalPrintNum}, total number of ejects: {self.totalEjectFCNum}'
 
 class SupportFunctionInfoResponse():
+    __slots__ = ('type', 'info')
+
     def __init__(self, data):
         self.info = None
         type, = unpack_from('>B', data)
@@ -437,6 +663,8 @@ class SupportFunctionInfoResponse():
         return f'Support function info type: {self.type.name}\n' + self.info.__str__()
 
 class VoltageInfo():
+    __slots__ = ('batteryVoltage', 'printerTemperature')
+
     def __init__(self, batteryVoltage, printerTemperature):
         self.batteryVoltage = batteryVoltage # unsigned short
         self.printerTemperature = printerTemperature # unsigned short
@@ -445,16 +673,24 @@ class VoltageInfo():
         return f'Battery voltage: {self.batteryVoltage}, printer temperature: {self.printerTemperature}'
 
 class ColorInfo():
+    __slots__ = ('totalNumberOfPrintAttempts', 'batteryType', 'colorVariationData', 'withOrWithoutFilmPI')
+
     def __init__(self, totalNumberOfPrintAttempts, batteryType, colorVariationInformation, withOrWithoutFilmPI):
         self.totalNumberOfPrintAttempts = totalNumberOfPrintAttempts # unsigned int
         self.batteryType = batteryType # unsigned short
-        self.colorVariationInformation = CameraColor(colorVariationInformation) # unsigned short
+        self.colorVariationData = colorVariationInformation # unsigned short
         self.withOrWithoutFilmPI = withOrWithoutFilmPI # unsigned short
 
+    @property
+    def colorVariationInformation(self):
+        return CameraColor(self.colorVariationData)
+
     def __str__(self):
         return f'Total number of print attempts: {self.totalNumberOfPrintAttempts}, battery type: {self.batteryType}, color variation: {self.colorVariationInformation.name}, with or without film PI: {self.withOrWithoutFilmPI}'
 
 class AdditionalPrinterInfoResponse():
+    __slots__ = ('type', 'info')
+
     def __init__(self, data):
         self.info = None
         type, = unpack_from('>B', data)
@@ -470,6 +706,8 @@ class AdditionalPrinterInfoResponse():
         return f'Additional printer info type: {self.type.name}\n' + self.info.__str__()
 
 class AutoSleepSettingsResponse():
+    __slots__ = ('autoSleepTime1', 'autoSleepTime2', 'autoSleepTime3', 'autoSleepTime4')
+
     def __init__(self, data):
         self.autoSleepTime1, self.autoSleepTime2, self.autoSleepTime3, self.autoSleepTime4 = unpack_from('>HHHH', data)
 
@@ -477,6 +715,8 @@ class AutoSleepSettingsResponse():
         return f'Auto sleep time 1: {self.autoSleepTime1}, auto sleep time 2: {self.autoSleepTime2}, auto sleep time 3: {self.autoSleepTime3}, auto sleep time 4: {self.autoSleepTime4}'
 
 class ImageTransferStartResponse():
+    __slots__ = ('frameSize',)
+
     def __init__(self, data):
         self.frameSize, = unpack_from('>I', data)
 
@@ -484,6 +724,8 @@ class ImageTransferStartResponse():
         return f'Frame size: {self.frameSize}'
 
 class ImageFrameTransferResponse():
+    __slots__ = ('frameNumber',)
+
     def __init__(self, data):
         self.frameNumber, = unpack_from('>I', data)
 
@@ -491,6 +733,8 @@ class ImageFrameTransferResponse():
         return f'Frame number: {self.frameNumber}'
 
 class ImagePrintResponse():
+    __slots__ = ('endTime',)
+
     def __init__(self, data):
         self.endTime, = unpack_from('>B', data)
 
@@ -498,64 +742,237 @@ class ImagePrintResponse():
         return f'End time: {self.endTime}'
 
 class LightCorrectInfoResponse():
+    __slots__ = ('printerHeadTypeData', 'printingDateJudgeFlag', 'year', 'month', 'day', 'rIntensity', 'gIntensity', 'bIntensity')
+
     def __init__(self, data):
-        printerHeadType, self.printingDateJudgeFlag, padding, self.year, self.month, self.day, self.rIntensity, self.gIntensity, self.bIntensity = unpack_from('>BBBHBBHHH', data)
-        self.printerHeadType = PrinterMountedHeadType(printerHeadType)
+        self.printerHeadTypeData, self.printingDateJudgeFlag, padding, self.year, self.month, self.day, self.rIntensity, self.gIntensity, self.bIntensity = unpack_from('>BBBHBBHHH', data)
+
+    @property
+    def printerHeadType(self):
+        return PrinterMountedHeadType(self.printerHeadTypeData)
 
     def __str__(self):
         return f'Printer head type: {self.printerHeadType.name}, date flag: {self.printingDateJudgeFlag}, year: {self.year}, month: {self.month}, day: {self.day}, R intensity: {self.rIntensity}, G intensity: {self.gIntensity}, B intensity: {self.bIntensity}'
 
+# Profiling
+
+class PhaseProfiler:
+    def __init__(self, cpu_profile = False):
+        self.phases = OrderedDict() # phase name -> [count, wall seconds, cpu seconds]
+        # from Python 3.12 cProfile is built on sys.monitoring, a single profiler sees every thread and no second one can be enabled
+        self.profilesAllThreads = sys.version_info >= (3, 12)
+        # cpu time rather than wall time, so time waiting on the printer doesn't show up as hot functions
+        self.cpuTimer = time.process_time if self.profilesAllThreads else time.thread_time
+        self.cpuProfile = cProfile.Profile(self.cpuTimer) if cpu_profile else None
+        self.threadProfiles = [] # profiles of work run on executor threads, merged in the report
+        self.startTime = None
+        self.startCpuTime = None
+        self.wallTime = 0.0
+        self.cpuTime = 0.0
+
+    def start(self):
+        self.startTime = time.monotonic()
+        self.startCpuTime = time.process_time()
+        if self.cpuProfile:
+            self.cpuProfile.enable()
+
+    def stop(self):
+        if self.cpuProfile:
+            self.cpuProfile.disable()
+        if self.startTime is not None:
+            self.wallTime += time.monotonic() - self.startTime
+            self.cpuTime += time.process_time() - self.startCpuTime
+            self.startTime = None
+
+    @contextmanager
+    def phase(self, name):
+        # cpu time is of the whole process, so it includes executor threads and any concurrent task
+        wallStart = time.monotonic()
+        cpuStart = time.process_time()
+        try:
+            yield
+        finally:
+            phase = self.phases.setdefault(name, [0, 0.0, 0.0])
+            phase[0] += 1
+            phase[1] += time.monotonic() - wallStart
+            phase[2] += time.process_time() - cpuStart
+
+    def call(self, function, *args): # for work handed to an executor thread, which the profiler of the loop thread doesn't see before Python 3.12
+        if not self.cpuProfile or self.profilesAllThreads:
+            return function(*args)
+        profile = cProfile.Profile(self.cpuTimer)
+        try:
+            profile.enable()
+        except ValueError: # another profiling tool is active, the work is then left out of the report
+            return function(*args)
+        try:
+            return function(*args)
+        finally:
+            profile.disable()
+            self.threadProfiles.append(profile)
+
+    def top_functions(self, count = 15):
+        if not self.cpuProfile:
+            return []
+        stats = pstats.Stats(self.cpuProfile)
+        for profile in self.threadProfiles:
+            stats.add(profile)
+        functions = sorted(stats.stats.items(), key = lambda item: item[1][2], reverse = True)[:count]
+        return [{'function': pstats.func_std_string(function), 'calls': calls, 'ownSeconds': round(ownTime, 6), 'cumulativeSeconds': round(cumulativeTime, 6)} for function, (primitiveCalls, calls, ownTime, cumulativeTime, callers) in functions]
+
+    def to_dict(self):
+        return {'host': platform.node(), 'timestamp': time.time(), 'wallSeconds': round(self.wallTime, 6), 'cpuSeconds': round(self.cpuTime, 6), 'phases': OrderedDict((name, {'count': count, 'wallSeconds': round(wallTime, 6), 'cpuSeconds': round(cpuTime, 6)}) for name, (count, wallTime, cpuTime) in self.phases.items()), 'cpuProfile': self.top_functions()}
+
+    def print_breakdown(self):
+        print("%-16s %6s %10s %10s %7s" % ('Phase', 'Count', 'Wall s', 'CPU s', 'Wall %'))
+        for name, (count, wallTime, cpuTime) in self.phases.items():
+            print("%-16s %6i %10.3f %10.3f %6.1f%%" % (name, count, wallTime, cpuTime, 100.0 * wallTime / self.wallTime if self.wallTime else 0.0))
+        print("%-16s %6s %10.3f %10.3f" % ('total', '', self.wallTime, self.cpuTime))
+        for function in self.top_functions(5):
+            print("%10.3f %10.3f %8i  %s" % (function['ownSeconds'], function['cumulativeSeconds'], function['calls'], function['function']))
+
 # Communication
 
-class InstaxSocketConnection:
-    def __init__(self, device_name, debug = False):
-        # TODO: find the port via SDP and UUID = "00001101-0000-1000-8000-00805F9B34FB"
-        self.port = 6
-        self.device_name = device_name.upper()
-        self.debug = debug
-        self.socket = None
-    
-    def discover(self):
-        devices = bluetooth.discover_devices(lookup_names = True) # list of tuples [(address, name)]
-        for device in devices:
-            if device[1].upper() == self.device_name:
-                return device[0]
-        return None
-    
-    def connect(self):
-        address = self.discover()
-        if address:
-            print("Found Instax Link at address: %s" % (address))
+class CommandPriority(Enum):
+    IMAGE_FRAME = 0
+    CONTROL = 1
+    QUERY = 2
+
+class CommandScheduler:
+    def __init__(self, connection):
+        self.connection = connection
+        self.queue = None
+        self.worker = None
+        self.sequence = itertools.count() # keeps FIFO order within a priority
+        self.pending = {} # payload -> future, for coalescable commands queued or in flight
+        self.halted = set() # priorities refused after a failure until resumed, see halt
+
+    async def submit(self, payload, priority, coalesce = False):
+        if coalesce and payload in self.pending:
+            return await asyncio.shield(self.pending[payload])
+        if priority.value in self.halted:
+            raise Exception("%s refused after a failed command of the same priority" % SID((payload[4], payload[5])).name)
+        if self.worker is None or self.worker.done():
+            self.queue = asyncio.PriorityQueue()
+            self.worker = asyncio.create_task(self.run())
+        future = asyncio.get_running_loop().create_future()
+        if coalesce:
+            self.pending[payload] = future
+        self.queue.put_nowait((priority.value, next(self.sequence), payload, future))
+        # shielded so that a cancelled caller doesn't cancel the result shared with coalesced callers
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not coalesce:
+                future.cancel() # nobody else waits for it, so it's dropped from the queue
+            raise
+
+    async def run(self):
+        while True:
+            priority, sequence, payload, future = await self.queue.get()
+            if future.cancelled():
+                continue
             try:
-                print("Attempting to connect...")
-                self.socket = bluetooth.BluetoothSocket()
-                self.socket.settimeout(5)
-                self.socket.connect((address, self.port))
-                print("Connected")
+                result = await self.send(payload)
+            except asyncio.CancelledError:
+                # stopped with the command in flight, its callers and the coalesced ones are cancelled like the queued commands
+                future.cancel()
+                raise
             except Exception as e:
-                print("Failed to connect! %s" % e)
-        else:
-            raise Exception("Instax Link %s not found" % self.device_name)
-        
-    def disconnect(self):
+                result = None
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                if self.pending.get(payload) is future:
+                    del self.pending[payload]
+            if result is None and priority == CommandPriority.IMAGE_FRAME.value:
+                # the frames queued or submitted behind one that failed or got an invalid reply would reach the printer out of sequence,
+                # they're refused until the uploader has gone back to the failed one
+                self.halt(priority)
+
+    def halt(self, priority):
+        # drops the queued commands of the priority and refuses new ones until resumed
+        self.halted.add(priority)
+        kept = []
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item[0] == priority:
+                item[3].cancel()
+            else:
+                kept.append(item)
+        for item in kept:
+            self.queue.put_nowait(item)
+
+    def resume(self, priority): # CommandPriority
+        self.halted.discard(priority.value)
+
+    async def send(self, payload):
+        timeout = self.connection.commandTimeout
+        if not timeout:
+            return await self.connection.send_command(payload)
         try:
-            print("Disconnecting...")
-            self.socket.close()
-            print("Disconnected")
-        except Exception as e:
-            print("Failed to disconnect! %s" % e)
+            return await asyncio.wait_for(self.connection.send_command(payload), timeout)
+        except asyncio.TimeoutError:
+            raise Exception("No response to %s within %g seconds" % (SID((payload[4], payload[5])).name, timeout))
+
+    def stop(self):
+        if self.worker:
+            self.worker.cancel()
+            self.worker = None
+        while self.queue and not self.queue.empty():
+            priority, sequence, payload, future = self.queue.get_nowait()
+            future.cancel()
+        self.pending.clear()
+
+class RetryPolicy:
+    def __init__(self, retries = None, delay = 1.0):
+        # result code -> number of retries, any other error code fails immediately
+        self.retries = {ResultCode.PRINTER_BUSY: 5, ResultCode.CAMERA_BUSY: 5}
+        self.retries.update(retries or {})
+        self.delay = delay # seconds between attempts
+
+    def should_retry(self, resultCode, attempt):
+        return attempt < self.retries.get(resultCode, 0)
+
+class InstaxConnection:
+    def __init__(self, device_name, debug = False):
+        self.device_name = device_name.upper()
+        self.debug = debug
+        self.commandTimeout = 10.0 # seconds, None waits forever
+        self.retryPolicy = RetryPolicy()
+        self.scheduler = CommandScheduler(self)
+        self.profiler = PhaseProfiler()
 
-    def get_info(self):
-        print("get_info is not implemented using Bluetooth Socket!")
+    async def send_command(self, payload):
+        raise NotImplementedError
 
-    def send_command(self, payload):
-        if self.debug:
-            print("Sending payload %s" % payload.hex(' ', 1))
-        self.socket.send(payload)
-        data = self.socket.recv(1024)
-        if self.debug:
-            print(data)
-        response = Response(data)
+    def is_reply(self, request, response): # outbound payload, inbound payload
+        # a late reply to a command that timed out must not be taken for the reply to the next one
+        if bytes(response[4:6]) != bytes(request[4:6]):
+            return False
+        # queries sharing a SID are told apart by the information type, which the reply echoes after the result code
+        if SID((request[4], request[5])) in (SID.DEVICE_INFO_SERVICE, SID.SUPPORT_FUNCTION_INFO, SID.ADDITIONAL_PRINTER_INFO) and len(response) > 8:
+            return response[7] == request[6]
+        return True
+
+    async def submit(self, request, priority = CommandPriority.QUERY):
+        attempt = 0
+        while True:
+            try:
+                # identical queries issued concurrently share a single round trip
+                return await self.scheduler.submit(request.message.get_payload(), priority, priority == CommandPriority.QUERY)
+            except InstaxResultError as e:
+                if not self.retryPolicy.should_retry(e.resultCode, attempt):
+                    raise
+                attempt += 1
+                print("%s, retrying %s (%i)" % (e, request.message.sid.name, attempt))
+                await asyncio.sleep(self.retryPolicy.delay)
+
+    def parse_response(self, payload):
+        response = Response(payload)
         if self.debug:
             print("Received response %s" % response)
         if response.valid:
@@ -572,82 +989,176 @@ class InstaxSocketConnection:
                 return LightCorrectInfoResponse(response.message.data)
             elif sid == SID.AUTO_SLEEP_SETTINGS:
                 return AutoSleepSettingsResponse(response.message.data)
-            elif sid == SID.PRINT_IMAGE_DOWNLOAD_START:
+            elif sid in (SID.PRINT_IMAGE_DOWNLOAD_START, SID.FW_DOWNLOAD_START, SID.FRAME_PICTURE_DOWNLOAD_START):
                 return ImageTransferStartResponse(response.message.data)
-            elif sid == SID.PRINT_IMAGE_DOWNLOAD_DATA:
+            elif sid in (SID.PRINT_IMAGE_DOWNLOAD_DATA, SID.FW_DOWNLOAD_DATA, SID.FRAME_PICTURE_DOWNLOAD):
                 return ImageFrameTransferResponse(response.message.data)
-            elif sid == SID.PRINT_IMAGE_DOWNLOAD_END:
+            elif sid in (SID.PRINT_IMAGE_DOWNLOAD_END, SID.FW_DOWNLOAD_END, SID.FRAME_PICTURE_DOWNLOAD_END, SID.PRINT_IMAGE_DOWNLOAD_CANCEL):
                 return None
             elif sid == SID.PRINT_IMAGE:
                 return ImagePrintResponse(response.message.data)
             else:
                 print("Unsupported SID %s!" % sid.name)
                 return None
+        elif response.message.validate_size() and response.message.validate_signature() and response.message.validate_checksum():
+            # an intact reply carrying an error code
+            raise InstaxResultError(response.message.resultCode)
         else:
             print("Invalid response!")
             return None
+
+    async def request_version_info(self):
+        return await self.submit(SupportFunctionaAndVersionInfoRequest())
     
-    def request_version_info(self):
-        return self.send_command(SupportFunctionaAndVersionInfoRequest().message.get_payload())
-    
-    def request_device_info_model(self):
-        return self.send_command(DeviceInfoRequest(DeviceInfoType.MODEL_NUMBER).message.get_payload())
+    async def request_device_info_model(self):
+        return await self.submit(DeviceInfoRequest(DeviceInfoType.MODEL_NUMBER))
     
-    def request_device_info_serial(self):
-        return self.send_command(DeviceInfoRequest(DeviceInfoType.SERIAL_NUMBER).message.get_payload())
+    async def request_device_info_serial(self):
+        return await self.submit(DeviceInfoRequest(DeviceInfoType.SERIAL_NUMBER))
     
-    def request_device_info_hw(self):
-        return self.send_command(DeviceInfoRequest(DeviceInfoType.HW_REVISION).message.get_payload())
+    async def request_device_info_hw(self):
+        return await self.submit(DeviceInfoRequest(DeviceInfoType.HW_REVISION))
     
-    def request_function_info_image(self):
-        return self.send_command(SupportFunctionInfoRequest(SupportFunctionInfoType.IMAGE_SUPPORT_INFO).message.get_payload())
+    async def request_function_info_image(self):
+        return await self.submit(SupportFunctionInfoRequest(SupportFunctionInfoType.IMAGE_SUPPORT_INFO))
     
-    def request_function_info_battery(self):
-        return self.send_command(SupportFunctionInfoRequest(SupportFunctionInfoType.BATTERY_INFO).message.get_payload())
+    async def request_function_info_battery(self):
+        return await self.submit(SupportFunctionInfoRequest(SupportFunctionInfoType.BATTERY_INFO))
     
-    def request_function_info_printer_function(self):
-        return self.send_command(SupportFunctionInfoRequest(SupportFunctionInfoType.PRINTER_FUNCTION_INFO).message.get_payload())
+    async def request_function_info_printer_function(self):
+        return await self.submit(SupportFunctionInfoRequest(SupportFunctionInfoType.PRINTER_FUNCTION_INFO))
     
-    def request_function_info_print_history(self):
-        return self.send_command(SupportFunctionInfoRequest(SupportFunctionInfoType.PRINT_HISTORY_INFO).message.get_payload())
+    async def request_function_info_print_history(self):
+        return await self.submit(SupportFunctionInfoRequest(SupportFunctionInfoType.PRINT_HISTORY_INFO))
     
-    def request_printer_info_voltage(self):
-        return self.send_command(AdditionalPrinterInfoRequest(AdditionalPrinterInfoType.VOLTAGE_INFO).message.get_payload())
+    async def request_printer_info_voltage(self):
+        return await self.submit(AdditionalPrinterInfoRequest(AdditionalPrinterInfoType.VOLTAGE_INFO))
 
-    def request_printer_info_color(self):
-        return self.send_command(AdditionalPrinterInfoRequest(AdditionalPrinterInfoType.COLOR_INFO).message.get_payload())
+    async def request_printer_info_color(self):
+        return await self.submit(AdditionalPrinterInfoRequest(AdditionalPrinterInfoType.COLOR_INFO))
     
-    def request_request_head_calibration_info(self):
-        return self.send_command(LightCorrectInfoRequest().message.get_payload())
+    async def request_request_head_calibration_info(self):
+        return await self.submit(LightCorrectInfoRequest())
 
-    def request_sleep_settings_extend(self, time1, time2, time3, time4):
-        return self.send_command(AutoSleepSettingsRequest(AutoSleepSettingsMode.EXTEND_CURRENT_SLEEP_SETTING, time1, time2, time3, time4).message.get_payload())
+    async def request_sleep_settings_extend(self, time1, time2, time3, time4):
+        return await self.submit(AutoSleepSettingsRequest(AutoSleepSettingsMode.EXTEND_CURRENT_SLEEP_SETTING, time1, time2, time3, time4), CommandPriority.CONTROL)
     
-    def request_image_transfer_start(self, pictureType, picturePrintOption, size):
-        return self.send_command(ImageTransferStartRequest(pictureType, picturePrintOption, size).message.get_payload())
+    async def request_image_transfer_start(self, pictureType, picturePrintOption, size):
+        return await self.submit(ImageTransferStartRequest(pictureType, picturePrintOption, size), CommandPriority.CONTROL)
     
-    def request_image_frame_transfer(self, frameNumber, frameData):
-        return self.send_command(ImageFrameTransferRequest(frameNumber, frameData).message.get_payload())
+    async def request_image_frame_transfer(self, frameNumber, frameData):
+        return await self.submit(ImageFrameTransferRequest(frameNumber, frameData), CommandPriority.IMAGE_FRAME)
     
-    def request_image_transfer_end(self):
-        return self.send_command(ImageTransferEndRequest().message.get_payload())
+    async def request_image_transfer_end(self):
+        return await self.submit(ImageTransferEndRequest(), CommandPriority.CONTROL)
+
+    async def request_image_transfer_cancel(self):
+        return await self.submit(ImageTransferCancelRequest(), CommandPriority.CONTROL)
+    
+    async def request_print(self):
+        return await self.submit(ImagePrintRequest(), CommandPriority.CONTROL)
+
+class InstaxSocketConnection(InstaxConnection):
+    def __init__(self, device_name, debug = False):
+        super().__init__(device_name, debug)
+        # TODO: find the port via SDP and UUID = "00001101-0000-1000-8000-00805F9B34FB"
+        self.port = 6
+        self.socket = None
+        # pybluez sockets are blocking and not selectable on every platform, so all socket I/O runs on a dedicated thread
+        self.executor = None
+
+    async def run_blocking(self, function, *args):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'InstaxSocketConnection')
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+    
+    def discover_blocking(self):
+        devices = bluetooth.discover_devices(lookup_names = True) # list of tuples [(address, name)]
+        for device in devices:
+            if device[1].upper() == self.device_name:
+                return device[0]
+        return None
+
+    async def discover(self):
+        return await self.run_blocking(self.discover_blocking)
     
-    def request_print(self):
-        return self.send_command(ImagePrintRequest().message.get_payload())
+    async def connect(self, address = None): # address of an already discovered device, skips discovery
+        if address is None:
+            with self.profiler.phase('discovery'):
+                address = await self.discover()
+        if address:
+            print("Found Instax Link at address: %s" % (address))
+            try:
+                print("Attempting to connect...")
+                self.socket = bluetooth.BluetoothSocket()
+                self.socket.settimeout(self.commandTimeout or None)
+                with self.profiler.phase('connect'):
+                    await self.run_blocking(self.socket.connect, (address, self.port))
+                print("Connected")
+            except Exception as e:
+                print("Failed to connect! %s" % e)
+        else:
+            raise Exception("Instax Link %s not found" % self.device_name)
+        
+    async def disconnect(self):
+        self.scheduler.stop()
+        try:
+            print("Disconnecting...")
+            await self.run_blocking(self.socket.close)
+            print("Disconnected")
+        except Exception as e:
+            print("Failed to disconnect! %s" % e)
+        finally:
+            if self.executor:
+                self.executor.shutdown(wait = False)
+                self.executor = None
+
+    async def get_info(self):
+        print("get_info is not implemented using Bluetooth Socket!")
+
+    def exchange(self, payload):
+        self.drain()
+        self.socket.send(payload)
+        while True:
+            data = self.socket.recv(1024)
+            if not data:
+                raise Exception("Connection closed by the printer")
+            if self.is_reply(payload, data):
+                return data
+            if self.debug:
+                print("Discarded unexpected response %s" % data.hex(' ', 1))
+
+    def drain(self):
+        # replies to commands that timed out are still buffered in the socket
+        self.socket.settimeout(0)
+        try:
+            while self.socket.recv(1024):
+                pass
+        except Exception: # nothing left to read
+            pass
+        finally:
+            self.socket.settimeout(self.commandTimeout or None)
 
-class InstaxBLEConnection:
+    async def send_command(self, payload):
+        if self.debug:
+            print("Sending payload %s" % payload.hex(' ', 1))
+        data = await self.run_blocking(self.exchange, payload)
+        if self.debug:
+            print(data)
+        return self.parse_response(data)
+
+class InstaxBLEConnection(InstaxConnection):
     def __init__(self, device_name, debug = False):
+        super().__init__(device_name, debug)
 
         self.serviceUUID = '70954782-2d83-473d-9e5f-81e1d02d5273'
         self.writeCharacteristicUUID = '70954783-2d83-473d-9e5f-81e1d02d5273'
         self.notifyCharacteristicUUID = '70954784-2d83-473d-9e5f-81e1d02d5273'
-        
-        self.device_name = device_name.upper()
-        self.debug = debug
 
         self.client = None
-        self.responseReceived = False
-        self.response = None
+        self.responseFuture = None
+        self.pendingRequest = None # payload of the command awaiting its reply
+        self.readDeviceInfo = True # read and print the GATT device information on connect
     
     async def discover(self):
         devices = await BleakScanner.discover(5.0, return_adv = True)
@@ -657,24 +1168,30 @@ class InstaxBLEConnection:
                 return device
         return None
 
-    async def connect(self):
-        device = await self.discover()
+    async def connect(self, device = None): # address of an already discovered device, skips discovery
+        if device is None:
+            with self.profiler.phase('discovery'):
+                device = await self.discover()
         if device:
             print("Found Instax Link at address: %s" % (device))
             try:
                 print("Attempting to connect...")
                 self.client = BleakClient(device)
-                await self.client.connect()
+                with self.profiler.phase('connect'):
+                    await self.client.connect()
+                    await self.client.start_notify(self.notifyCharacteristicUUID, self.response_callback)
                 print("Connected")
-                await self.get_info()
-                await self.client.start_notify(self.notifyCharacteristicUUID, self.response_callback)
                 print("Callback set")
+                if self.readDeviceInfo:
+                    with self.profiler.phase('get_info'):
+                        await self.get_info()
             except Exception as e:
                 print("Failed to connect! %s" % e)
         else:
             raise Exception("Instax Link %s not found" % self.device_name)
 
     async def disconnect(self):
+        self.scheduler.stop()
         try:
             print("Disconnecting...")
             await self.client.disconnect()
@@ -730,113 +1247,207 @@ class InstaxBLEConnection:
             raise Exception("Failed to read PnP ID")
 
     async def send_command(self, payload):
+        self.responseFuture = asyncio.get_running_loop().create_future()
+        self.pendingRequest = payload
         maxPacketSize = 182
         numberOfPackets = math.ceil(len(payload) / maxPacketSize)
-        for packetIndex in range(numberOfPackets):
-            packet = payload[packetIndex * maxPacketSize:packetIndex * maxPacketSize + maxPacketSize]
-            if self.debug:
-                print("Sending payload %s" % packet.hex(' ', 1))
-            await self.client.write_gatt_char(self.writeCharacteristicUUID, packet, False)
-        while self.responseReceived == False:
-            await asyncio.sleep(0.1)
-        self.responseReceived = False
+        try:
+            for packetIndex in range(numberOfPackets):
+                packet = payload[packetIndex * maxPacketSize:packetIndex * maxPacketSize + maxPacketSize]
+                if self.debug:
+                    print("Sending payload %s" % packet.hex(' ', 1))
+                await self.client.write_gatt_char(self.writeCharacteristicUUID, packet, False)
+            response = await self.responseFuture
+        finally:
+            self.responseFuture = None
         if self.debug:
-            print(self.response)
-        return self.response
+            print(response)
+        return response
     
     def response_callback(self, characteristic, payload):
-        response = Response(payload)
-        if self.debug:
-            print("Received response %s" % response)
-        if response.valid:
-            sid = response.message.sid
-            if sid == SID.SUPPORT_FUNCTION_AND_VERSION_INFO:
-                self.response = SupportFunctionaAndVersionInfoResponse(response.message.data)
-            elif sid == SID.DEVICE_INFO_SERVICE:
-                self.response = DeviceInfoResponse(response.message.data)
-            elif sid == SID.SUPPORT_FUNCTION_INFO:
-                self.response = SupportFunctionInfoResponse(response.message.data)
-            elif sid == SID.ADDITIONAL_PRINTER_INFO:
-                self.response = AdditionalPrinterInfoResponse(response.message.data)
-            elif sid == SID.PRINTER_HEAD_LIGHT_CORRECT_INFO:
-                self.response = LightCorrectInfoResponse(response.message.data)
-            elif sid == SID.AUTO_SLEEP_SETTINGS:
-                self.response = AutoSleepSettingsResponse(response.message.data)
-            elif sid == SID.PRINT_IMAGE_DOWNLOAD_START:
-                self.response = ImageTransferStartResponse(response.message.data)
-            elif sid == SID.PRINT_IMAGE_DOWNLOAD_DATA:
-                self.response = ImageFrameTransferResponse(response.message.data)
-            elif sid == SID.PRINT_IMAGE_DOWNLOAD_END:
-                self.response = None
-            elif sid == SID.PRINT_IMAGE:
-                self.response = ImagePrintResponse(response.message.data)
-            else:
-                print("Unsupported SID %s!" % sid.name)
-                self.response = None
-        else:
-            print("Invalid response!")
-        self.responseReceived = True
-    
-    async def request_version_info(self):
-        return await self.send_command(SupportFunctionaAndVersionInfoRequest().message.get_payload())
-    
-    async def request_device_info_model(self):
-        return await self.send_command(DeviceInfoRequest(DeviceInfoType.MODEL_NUMBER).message.get_payload())
-    
-    async def request_device_info_serial(self):
-        return await self.send_command(DeviceInfoRequest(DeviceInfoType.SERIAL_NUMBER).message.get_payload())
-    
-    async def request_device_info_hw(self):
-        return await self.send_command(DeviceInfoRequest(DeviceInfoType.HW_REVISION).message.get_payload())
-    
-    async def request_function_info_image(self):
-        return await self.send_command(SupportFunctionInfoRequest(SupportFunctionInfoType.IMAGE_SUPPORT_INFO).message.get_payload())
-    
-    async def request_function_info_battery(self):
-        return await self.send_command(SupportFunctionInfoRequest(SupportFunctionInfoType.BATTERY_INFO).message.get_payload())
-    
-    async def request_function_info_printer_function(self):
-        return await self.send_command(SupportFunctionInfoRequest(SupportFunctionInfoType.PRINTER_FUNCTION_INFO).message.get_payload())
-    
-    async def request_function_info_print_history(self):
-        return await self.send_command(SupportFunctionInfoRequest(SupportFunctionInfoType.PRINT_HISTORY_INFO).message.get_payload())
-    
-    async def request_printer_info_voltage(self):
-        return await self.send_command(AdditionalPrinterInfoRequest(AdditionalPrinterInfoType.VOLTAGE_INFO).message.get_payload())
+        # a late notification for a command that already timed out is discarded
+        if self.responseFuture is None or self.responseFuture.done() or not self.is_reply(self.pendingRequest, payload):
+            if self.debug:
+                print("Discarded unexpected response %s" % payload.hex(' ', 1))
+            return
+        try:
+            self.responseFuture.set_result(self.parse_response(payload))
+        except Exception as e:
+            self.responseFuture.set_exception(e)
+
+class InstaxSimulatorConnection(InstaxConnection):
+    def __init__(self, device_name = 'SIMULATOR', debug = False, latency = 0.0, frame_size = 900, failure_rate = 0.0, stall_rate = 0.0, seed = None):
+        super().__init__(device_name, debug)
+        self.latency = latency # seconds per command
+        self.frameSize = frame_size
+        self.failureRate = failure_rate # probability of garbling the response to an upload frame
+        self.stallRate = stall_rate # probability of never answering a command
+        self.random = random.Random(seed)
+        self.filmRemain = 10
+        self.processingPolls = 0
+        self.uploadType = None
+        self.uploadSize = 0
+        self.uploadData = bytearray()
+        self.uploads = {} # BulkUploadType -> bytes of the last completed upload
+
+    async def connect(self, address = None):
+        print("Connected to simulated Instax Link %s" % self.device_name)
 
-    async def request_printer_info_color(self):
-        return await self.send_command(AdditionalPrinterInfoRequest(AdditionalPrinterInfoType.COLOR_INFO).message.get_payload())
-    
-    async def request_request_head_calibration_info(self):
-        return await self.send_command(LightCorrectInfoRequest().message.get_payload())
+    async def disconnect(self):
+        self.scheduler.stop()
+        print("Disconnected")
 
-    async def request_sleep_settings_extend(self, time1, time2, time3, time4):
-        return await self.send_command(AutoSleepSettingsRequest(AutoSleepSettingsMode.EXTEND_CURRENT_SLEEP_SETTING, time1, time2, time3, time4).message.get_payload())
-    
-    async def request_image_transfer_start(self, pictureType, picturePrintOption, size):
-        return await self.send_command(ImageTransferStartRequest(pictureType, picturePrintOption, size).message.get_payload())
-    
-    async def request_image_frame_transfer(self, frameNumber, frameData):
-        return await self.send_command(ImageFrameTransferRequest(frameNumber, frameData).message.get_payload())
-    
-    async def request_image_transfer_end(self):
-        return await self.send_command(ImageTransferEndRequest().message.get_payload())
-    
-    async def request_print(self):
-        return await self.send_command(ImagePrintRequest().message.get_payload())
+    async def get_info(self):
+        print("Simulated Instax Link, no device information available")
+
+    async def send_command(self, payload):
+        if self.debug:
+            print("Sending payload %s" % payload.hex(' ', 1))
+        await asyncio.sleep(self.latency)
+        if self.random.random() < self.stallRate:
+            await asyncio.Event().wait() # a lost response, only a deadline ends it
+        sid = SID((payload[4], payload[5]))
+        if sid in (uploadType.value[1] for uploadType in BulkUploadType) and self.random.random() < self.failureRate:
+            # the frame is lost and the response garbled
+            response = InboundMessage.build(sid, ResultCode.OK, payload[6:10]).payload
+            return self.parse_response(response[:-1] + pack('>B', response[-1] ^ 255))
+        resultCode, data = self.execute(sid, payload[6:-1])
+        return self.parse_response(InboundMessage.build(sid, resultCode, data).payload)
+
+    def execute(self, sid, data):
+        uploadType = next((uploadType for uploadType in BulkUploadType if sid in uploadType.value), None)
+        if sid == SID.DEVICE_INFO_SERVICE:
+            value = {DeviceInfoType.MODEL_NUMBER: b'SIMULATOR', DeviceInfoType.SERIAL_NUMBER: b'00000000', DeviceInfoType.HW_REVISION: b'0'}.get(DeviceInfoType(data[0]), b'')
+            return ResultCode.OK, pack('>BB', data[0], len(value)) + value
+        elif sid == SID.SUPPORT_FUNCTION_INFO:
+            type = SupportFunctionInfoType(data[0])
+            if type == SupportFunctionInfoType.IMAGE_SUPPORT_INFO:
+                return ResultCode.OK, pack('>BHHBBI', type.value, 1260, 840, PictureType.PICINF_PICTYPE_JPEG.value[0], 0, 337920)
+            elif type == SupportFunctionInfoType.BATTERY_INFO:
+                return ResultCode.OK, pack('>BBBBB', type.value, 3, 80, 0, 0)
+            elif type == SupportFunctionInfoType.PRINTER_FUNCTION_INFO:
+                result = PrinterResults.PRINTER_PROCESSING if self.processingPolls > 0 else PrinterResults.NORMAL_TERMINATION
+                self.processingPolls = max(0, self.processingPolls - 1)
+                return ResultCode.OK, pack('>BBBBBI', type.value, (4 << 4) | self.filmRemain, 0, result.value, 0, 0)
+            elif type == SupportFunctionInfoType.PRINT_HISTORY_INFO:
+                return ResultCode.OK, pack('>BII', type.value, 10 - self.filmRemain, 0)
+        elif sid == SID.ADDITIONAL_PRINTER_INFO and data[0] == AdditionalPrinterInfoType.VOLTAGE_INFO.value:
+            return ResultCode.OK, pack('>BHH', data[0], 3700, 30)
+        elif sid == SID.PRINTER_HEAD_LIGHT_CORRECT_INFO:
+            return ResultCode.OK, pack('>BBBHBBHHH', PrinterMountedHeadType.FUTABA.value, 0, 0, 2024, 1, 1, 1000, 1000, 1000)
+        elif uploadType and sid == uploadType.value[0]:
+            self.uploadType = uploadType
+            self.uploadSize, = unpack_from('>I', data, len(data) - 4)
+            self.uploadData = bytearray()
+            return ResultCode.OK, pack('>I', self.frameSize)
+        elif uploadType and sid == uploadType.value[1]:
+            frameNumber, = unpack_from('>I', data)
+            if uploadType != self.uploadType or frameNumber * self.frameSize != len(self.uploadData):
+                return ResultCode.SEQUENCE_ERROR, b''
+            self.uploadData += data[4:]
+            return ResultCode.OK, pack('>I', frameNumber)
+        elif uploadType and sid == uploadType.value[2]:
+            if uploadType != self.uploadType or len(self.uploadData) < self.uploadSize:
+                return ResultCode.SEQUENCE_ERROR, b''
+            self.uploads[uploadType] = bytes(self.uploadData[:self.uploadSize])
+            self.uploadType = None
+            return ResultCode.OK, b''
+        elif sid == SID.PRINT_IMAGE_DOWNLOAD_CANCEL:
+            self.uploadType = None
+            self.uploadData = bytearray()
+            return ResultCode.OK, b''
+        elif sid == SID.PRINT_IMAGE:
+            if BulkUploadType.PRINT_IMAGE not in self.uploads or self.filmRemain == 0:
+                return ResultCode.CAMERA_NO_FILM_ERROR if self.filmRemain == 0 else ResultCode.SEQUENCE_ERROR, b''
+            self.filmRemain -= 1
+            self.processingPolls = 2
+            return ResultCode.OK, pack('>B', 2)
+        return ResultCode.SID_NOT_SUPPORTED, b''
+
+# Upload
+
+class BulkUploader:
+    def __init__(self, connection, window = 2, retries = 3, progress = None):
+        self.connection = connection
+        self.window = window # frames queued on the connection ahead of the acknowledged one
+        self.retries = retries # consecutive failures tolerated for a frame
+        self.progress = progress # callable(frames acknowledged, number of frames)
+
+    async def upload(self, uploadType, buffer, startRequest = None): # BulkUploadType, any sliceable buffer, Request
+        startResponse = await self.connection.submit(startRequest or UploadStartRequest(uploadType, len(buffer)), CommandPriority.CONTROL)
+        if startResponse is None:
+            raise Exception("Printer refused to start the %s upload" % uploadType.name)
+        frameSize = startResponse.frameSize
+        numberOfFrames = math.ceil(len(buffer) / frameSize)
+        if self.connection.debug:
+            print("Requested frame size %i, number of frames %i" % (frameSize, numberOfFrames))
+        # frames are queued ahead on the connection, so the next one goes on the wire as soon as the previous is acknowledged
+        inFlight = deque()
+        try:
+            await self.send_frames(uploadType, buffer, frameSize, numberOfFrames, inFlight)
+        finally:
+            # on failure or cancellation the frames still queued are dropped
+            for frameNumber, sent in inFlight:
+                sent.cancel()
+        await self.connection.submit(UploadEndRequest(uploadType), CommandPriority.CONTROL)
+        return numberOfFrames
+
+    async def send_frames(self, uploadType, buffer, frameSize, numberOfFrames, inFlight):
+        self.connection.scheduler.resume(CommandPriority.IMAGE_FRAME) # a previous upload may have given up after a failure
+        nextFrame = 0
+        acknowledged = 0
+        failures = 0
+        while acknowledged < numberOfFrames:
+            while nextFrame < numberOfFrames and len(inFlight) < self.window:
+                request = UploadFrameRequest(uploadType, nextFrame, slice_frame(buffer, frameSize, nextFrame))
+                inFlight.append((nextFrame, asyncio.ensure_future(self.connection.submit(request, CommandPriority.IMAGE_FRAME))))
+                nextFrame += 1
+            frameNumber, sent = inFlight.popleft()
+            try:
+                response = await sent
+            except InstaxResultError as e:
+                # the retry policy was already applied, only frames out of sequence after a failure are resent
+                if e.resultCode != ResultCode.SEQUENCE_ERROR:
+                    raise
+                response = None
+            except Exception as e:
+                print("Failed to transfer frame number %i! %s" % (frameNumber + 1, e))
+                response = None
+            if response is None or response.frameNumber != frameNumber:
+                # go back to the failed frame, the frames queued after it are out of sequence
+                # the ones still queued are dropped before going on the wire, an out of sequence frame may abort the download
+                for _, later in inFlight:
+                    later.cancel()
+                await asyncio.gather(*[later for _, later in inFlight], return_exceptions = True)
+                inFlight.clear()
+                self.connection.scheduler.resume(CommandPriority.IMAGE_FRAME)
+                failures += 1
+                if failures > self.retries:
+                    raise Exception("Failed to transfer frame number %i of %i" % (frameNumber + 1, numberOfFrames))
+                nextFrame = frameNumber
+                continue
+            failures = 0
+            acknowledged += 1
+            if self.progress:
+                self.progress(acknowledged, numberOfFrames)
 
 # Printer
 
 class InstaxPrinter:
-    def __init__(self, device_name, image_path = None, debug = False):
+    def __init__(self, device_name, image_path = None, lut_path = None, head_reference = None, command_timeout = 10.0, job_timeout = 300.0, retries = None, profiler = None, debug = False):
         self.debug = debug
         self.connection = None
-        self.concurrent = False
-        if "ANDROID" in device_name.upper():
+        if device_name.upper() == "SIMULATOR":
+            self.connection = InstaxSimulatorConnection(device_name, debug)
+        elif "ANDROID" in device_name.upper():
             self.connection = InstaxSocketConnection(device_name, debug)
         else:
             self.connection = InstaxBLEConnection(device_name, debug)
-            self.concurrent = True
+        self.connection.commandTimeout = command_timeout
+        self.connection.retryPolicy = RetryPolicy(dict(retries or []))
+        self.jobTimeout = job_timeout # seconds for a whole print job, None waits forever
+        self.profiler = profiler or PhaseProfiler()
+        self.connection.profiler = self.profiler
         
         self.model = ''
         self.serial = ''
@@ -846,39 +1457,47 @@ class InstaxPrinter:
         self.imageHeight = 0
         self.maxImageSize = 0
         self.picType = PictureType.PICINF_PICTYPE_NONE
+        self.lutAvailable = False
 
         self.batteryLevel = 0
         self.remainingPictures = 0
         self.printerStatus = PrinterResults.NORMAL_TERMINATION
 
         self.imagePath = image_path
-        self.imageFrameSize = 0
+        self.lutPath = lut_path
+        self.headReference = head_reference # (r, g, b) intensities the head is compensated to
+        self.headCompensation = None # Image.point table
+        self.printing = False
 
     def __str__(self):
         return f'Model: {self.model}, battery level: {self.batteryLevel}, remaining pictures: {self.remainingPictures}, status: {self.printerStatus.name}'
     
-    async def connect(self):
-        if self.concurrent:
-            await self.connection.connect()
+    async def connect(self, address = None): # address of an already discovered device, skips discovery
+        await self.connection.connect(address)
+        with self.profiler.phase('queries'):
             self.set_device_info(await self.connection.request_device_info_model())
             self.set_device_info(await self.connection.request_device_info_serial())
             self.set_device_info(await self.connection.request_device_info_hw())
             self.set_function_info(await self.connection.request_function_info_image())
             self.set_function_info(await self.connection.request_function_info_printer_function())
-        else:
-            self.connection.connect()
-            self.set_device_info(self.connection.request_device_info_model())
-            self.set_device_info(self.connection.request_device_info_serial())
-            self.set_device_info(self.connection.request_device_info_hw())
-            self.set_function_info(self.connection.request_function_info_image())
-            self.set_function_info(self.connection.request_function_info_printer_function())
+            if self.headReference:
+                self.headCompensation = head_compensation_table(await self.get_head_calibration(), self.headReference)
     
     async def disconnect(self):
-        if self.concurrent:
+        with self.profiler.phase('disconnect'):
             await self.connection.disconnect()
-        else:
-            self.connection.disconnect()
     
+    async def get_head_calibration(self):
+        # calibration is a property of the unit, so it's requested once per serial and reused across connections
+        if self.serial not in headCalibrationCache:
+            calibration = await self.connection.request_request_head_calibration_info()
+            if calibration is None:
+                raise Exception("Failed to read head calibration of %s" % self.serial)
+            headCalibrationCache[self.serial] = calibration
+            if self.debug:
+                print("Head calibration %s" % calibration)
+        return headCalibrationCache[self.serial]
+
     def set_device_info(self, data):
         if data.type == DeviceInfoType.MODEL_NUMBER:
             self.model = data.value
@@ -893,61 +1512,466 @@ class InstaxPrinter:
             self.imageHeight = data.info.height
             self.maxImageSize = data.info.size
             self.picType = data.info.picType
+            self.lutAvailable = data.info.is3DLutAvailable()
         elif data.type == SupportFunctionInfoType.PRINTER_FUNCTION_INFO:
             self.batteryLevel = data.info.batteryRemain
             self.remainingPictures = data.info.filmRemain
             self.printerStatus = data.info.resultPrintRequest
     
-    def set_image_transfer_info(self, data):
-        self.imageFrameSize = data.frameSize
-
-    def check_image(self):
-        if self.imagePath:
-            image = Image.open(self.imagePath)
-            if image.width == self.imageWidth and image.height == self.imageHeight and image.format == 'JPEG' and os.path.getsize(self.imagePath) <= self.maxImageSize:
-                return True
+    def check_image(self, imagePath):
+        if imagePath:
+            with Image.open(imagePath) as image:
+                if image.width == self.imageWidth and image.height == self.imageHeight and image.format == 'JPEG' and os.path.getsize(imagePath) <= self.maxImageSize:
+                    return True
         return False
     
-    def prepare_image(self): # TODO: resize and compress according to requirements, if needed
-        image = Image.open(self.imagePath)
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='JPEG')
-        return img_byte_arr.getvalue()
-    
-    async def print_image(self):
-        if self.imagePath:
-            if self.check_image():
-                with open(self.imagePath, 'rb') as image:
-                    img_byte_arr = image.read()
-                    if self.debug:
-                        print("Image size %i" % len(img_byte_arr))
-                    self.set_image_transfer_info(await self.connection.request_image_transfer_start(PictureType.PICINF_PICTYPE_JPEG, PicturePrintOption.PICINF_PICOP_NONE, len(img_byte_arr)))
-                    frames = slice_image(img_byte_arr, self.imageFrameSize)
-                    if self.debug:
-                        print("Requested frame size %i, prepared frame size %i, number of frames %i" % (self.imageFrameSize, len(frames[0]), len(frames)))
-                for i in range(len(frames)):
-                    frameNumber = (await self.connection.request_image_frame_transfer(i, frames[i])).frameNumber
-                    print("Transferred frame number %i of %i" % (frameNumber + 1, len(frames)))
-                await self.connection.request_image_transfer_end()
-                endTime = await self.connection.request_print()
+    def prepare_image(self, imagePath): # TODO: resize according to requirements, if needed
+        with Image.open(imagePath) as original:
+            image = original.convert('RGB')
+        if self.lutPath:
+            image = Image.fromarray(load_cube_lut(self.lutPath).apply(np.asarray(image)))
+        if self.headCompensation:
+            image = image.point(self.headCompensation)
+        # the highest quality that fits, the size of the JPEG grows with the quality
+        prepared = None
+        lowest, highest = 1, 95
+        quality = highest # most images fit at once
+        while lowest <= highest:
+            img_byte_arr = io.BytesIO()
+            image.save(img_byte_arr, format='JPEG', quality=quality)
+            if img_byte_arr.tell() <= self.maxImageSize:
+                prepared = img_byte_arr.getvalue()
+                lowest = quality + 1
+            else:
+                highest = quality - 1
+            quality = (lowest + highest) // 2
+        if prepared is None:
+            raise Exception("The prepared image exceeds the maximum size of %i KB" % self.maxImageSize)
+        return prepared
+    
+    async def transfer_image(self, imageBuffer, picturePrintOption): # any sliceable buffer, e.g. bytes or mmap
+        if self.debug:
+            print("Image size %i" % len(imageBuffer))
+        uploader = BulkUploader(self.connection, progress = lambda frames, numberOfFrames: print("Transferred frame number %i of %i" % (frames, numberOfFrames)))
+        try:
+            with self.profiler.phase('transfer'):
+                await uploader.upload(BulkUploadType.PRINT_IMAGE, imageBuffer, ImageTransferStartRequest(PictureType.PICINF_PICTYPE_JPEG, picturePrintOption, len(imageBuffer)))
+        except BaseException: # including the cancellation at the job deadline
+            await self.cancel_transfer()
+            raise
+
+    async def cancel_transfer(self):
+        # frees the printer for the next job, bounded by the command timeout in case the printer is gone
+        try:
+            print("Cancelling image transfer...")
+            await asyncio.shield(self.connection.request_image_transfer_cancel())
+        except BaseException as e:
+            print("Failed to cancel image transfer! %s" % e)
+
+    async def upload_file(self, uploadType, path): # BulkUploadType, path of the firmware or frame picture
+        with map_image(path) as buffer:
+            uploader = BulkUploader(self.connection, progress = lambda frames, numberOfFrames: print("Uploaded frame number %i of %i" % (frames, numberOfFrames)))
+            await uploader.upload(uploadType, buffer)
+
+    async def print_image(self, image_path = None):
+        imagePath = image_path or self.imagePath
+        self.printing = True
+        try:
+            if self.jobTimeout:
+                return await asyncio.wait_for(self.print_job(imagePath), self.jobTimeout)
+            return await self.print_job(imagePath)
+        except asyncio.TimeoutError:
+            raise Exception("Print job did not complete within %g seconds" % self.jobTimeout)
+        finally:
+            self.printing = False
+
+    async def print_job(self, imagePath):
+        if imagePath:
+            if self.check_image(imagePath):
+                if self.lutPath or self.headCompensation:
+                    with self.profiler.phase('prepare'):
+                        imageBuffer = await asyncio.get_running_loop().run_in_executor(None, self.profiler.call, self.prepare_image, imagePath)
+                    await self.transfer_image(imageBuffer, PicturePrintOption.PICINF_PICOP_3DLUT if self.lutPath and self.lutAvailable else PicturePrintOption.PICINF_PICOP_NONE)
+                else:
+                    # the file is memory mapped and streamed frame by frame, its pages stay in the shared page cache
+                    with map_image(imagePath) as imageBuffer:
+                        await self.transfer_image(imageBuffer, PicturePrintOption.PICINF_PICOP_NONE)
+                with self.profiler.phase('print'):
+                    endTime = (await self.connection.request_print()).endTime
                 print("Printing... Estimated time required %i seconds" % endTime)
-                self.set_function_info(await self.connection.request_function_info_printer_function())
-                while self.printerStatus == PrinterResults.PRINTER_PROCESSING:
+                with self.profiler.phase('status_polling'):
                     self.set_function_info(await self.connection.request_function_info_printer_function())
-                    await asyncio.sleep(1.0)
+                    while self.printerStatus == PrinterResults.PRINTER_PROCESSING:
+                        self.set_function_info(await self.connection.request_function_info_printer_function())
+                        await asyncio.sleep(1.0)
                 print("Print process completed with status %s" % self.printerStatus.name)
+                return self.printerStatus
             else:
                 print("The provided image cannot be printed! It must be a JPG file with height %i, width %i and maximum size %i KB" % (self.imageHeight, self.imageWidth, self.maxImageSize))
+        return None
+
+# Telemetry
+
+class TelemetrySample():
+    __slots__ = ('timestamp', 'batteryVoltage', 'printerTemperature', 'batteryLevel', 'batteryCapacity', 'totalPrintNum')
+
+    def __init__(self, timestamp, voltageInfo, batteryInfo, printHistoryInfo):
+        self.timestamp = timestamp # seconds since the epoch
+        self.batteryVoltage = voltageInfo.batteryVoltage
+        self.printerTemperature = voltageInfo.printerTemperature
+        self.batteryLevel = batteryInfo.batteryLevel
+        self.batteryCapacity = batteryInfo.batteryCapacity
+        self.totalPrintNum = printHistoryInfo.totalPrintNum
+
+    def __str__(self):
+        return f'Battery voltage: {self.batteryVoltage}, printer temperature: {self.printerTemperature}, battery level: {self.batteryLevel}, battery capacity: {self.batteryCapacity}, total number of prints: {self.totalPrintNum}'
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+class TelemetrySampler:
+    def __init__(self, printer, interval = 30.0, size = 120):
+        self.printer = printer
+        self.interval = interval # seconds between samples
+        self.samples = deque(maxlen = size)
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                sample = await self.sample()
+            except Exception as e:
+                print("Failed to sample telemetry! %s" % e)
+                continue
+            if sample:
+                self.samples.append(sample)
+
+    async def sample(self):
+        # sampling only happens between print jobs, a job starting midway discards the sample
+        readings = []
+        for request in (self.printer.connection.request_printer_info_voltage, self.printer.connection.request_function_info_battery, self.printer.connection.request_function_info_print_history):
+            if self.printer.printing:
+                return None
+            readings.append((await request()).info)
+        return TelemetrySample(time.time(), *readings)
+
+    def stats(self):
+        stats = {'count': len(self.samples)}
+        for field in ('batteryVoltage', 'printerTemperature', 'batteryLevel', 'batteryCapacity'):
+            values = [getattr(sample, field) for sample in self.samples]
+            if values:
+                stats[field] = {'last': values[-1], 'min': min(values), 'max': max(values), 'mean': sum(values) / len(values)}
+        return stats
+
+# Fleet
+
+class InstaxFleet:
+    def __init__(self, concurrency = 4, timeout = 60.0, scan_timeout = 5.0, command_timeout = 10.0, retries = None, debug = False):
+        self.concurrency = concurrency # printers connected at the same time
+        self.timeout = timeout # seconds for the whole snapshot, scan included
+        self.scanTimeout = scan_timeout
+        self.commandTimeout = command_timeout
+        self.retries = retries
+        self.debug = debug
+
+    async def discover(self, timeout): # -> list of (device name, address)
+        # a single scan finds every printer, each one advertises its BLE device with IOS in the name
+        devices = await BleakScanner.discover(timeout, return_adv = True)
+        printers = []
+        for device in devices:
+            name = (devices[device][1].local_name or '').upper()
+            if name.startswith('INSTAX-') and name.endswith('(IOS)'):
+                printers.append((name, device))
+        return sorted(printers)
+
+    async def status(self): # -> list of status dictionaries, one per printer found
+        deadline = time.monotonic() + self.timeout
+        printers = await self.discover(min(self.scanTimeout, self.timeout))
+        print("Found %i Instax Link printers" % len(printers))
+        if not printers:
+            return []
+        semaphore = asyncio.Semaphore(self.concurrency)
+        answers = [asyncio.get_running_loop().create_future() for printer in printers]
+        tasks = [asyncio.create_task(self.printer_status(semaphore, name, address, answer)) for (name, address), answer in zip(printers, answers)]
+        await asyncio.wait(answers, timeout = max(deadline - time.monotonic(), 0))
+        statuses = []
+        for (name, address), answer in zip(printers, answers):
+            if answer.done():
+                statuses.append(answer.result())
+            else:
+                statuses.append({'device': name, 'address': str(address), 'error': "No status within %g seconds" % self.timeout})
+        # disconnecting gets what's left of the deadline, the connections still open then are cancelled
+        done, pending = await asyncio.wait(tasks, timeout = max(deadline - time.monotonic(), 0))
+        for task in pending:
+            task.cancel()
+        if pending:
+            # a cancelled status read ends at once without disconnecting, the bound is only a guard
+            await asyncio.wait(pending, timeout = 1.0)
+        return statuses
+
+    async def printer_status(self, semaphore, name, address, answer): # answer is the future of the status dictionary
+        printer = InstaxPrinter(name, command_timeout = self.commandTimeout, retries = self.retries, debug = self.debug)
+        printer.connection.readDeviceInfo = False # model and serial are queried anyway, the GATT reads would only add round trips
+        status = {'device': name, 'address': str(address)}
+        try:
+            async with semaphore:
+                try:
+                    # connecting queries the model and the printer function info, which has film, battery and print result
+                    await printer.connect(address)
+                    status.update({'model': printer.model, 'serial': printer.serial, 'remainingPictures': printer.remainingPictures, 'batteryLevel': printer.batteryLevel, 'printerStatus': printer.printerStatus.name})
+                except Exception as e:
+                    status['error'] = str(e)
+                # the status counts as soon as it's read, however long disconnecting takes
+                answer.set_result(status)
+        except asyncio.CancelledError:
+            # past the deadline nothing more is awaited, the connection is dropped when the process exits
+            printer.connection.scheduler.stop()
+            raise
+        await printer.disconnect()
+
+    def format_table(self, statuses):
+        rows = [('Device', 'Model', 'Serial', 'Film', 'Battery', 'Status')]
+        for status in statuses:
+            if 'error' in status:
+                rows.append((status['device'], status.get('model', ''), status.get('serial', ''), '', '', status['error']))
+            else:
+                rows.append((status['device'], status['model'], status['serial'], str(status['remainingPictures']), str(status['batteryLevel']), status['printerStatus']))
+        widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]) - 1)]
+        return '\n'.join('  '.join(value.ljust(width) for value, width in zip(row, widths)) + '  ' + row[-1] for row in rows)
+
+# Server
+
+class PrintJob:
+    def __init__(self, imagePath, size):
+        self.id = uuid.uuid4().hex
+        self.imagePath = imagePath
+        self.size = size
+        self.state = 'queued' # queued, printing, done, failed
+        self.printerStatus = None # PrinterResults
+        self.error = None
+
+    def to_dict(self):
+        return {'id': self.id, 'state': self.state, 'size': self.size, 'printerStatus': self.printerStatus.name if self.printerStatus else None, 'error': self.error}
+
+class InstaxPrintServer:
+    def __init__(self, printer, host = '127.0.0.1', port = 8080, queue_size = 8, max_clients = 4, history_size = 100, telemetry_interval = 0, telemetry_size = 120, read_timeout = 30.0):
+        self.printer = printer
+        self.telemetry = TelemetrySampler(printer, telemetry_interval, telemetry_size) if telemetry_interval > 0 else None
+        self.host = host
+        self.port = port
+        self.queueSize = queue_size
+        self.maxClients = max_clients
+        self.historySize = history_size
+        self.chunkSize = 65536
+        self.readTimeout = read_timeout # seconds to receive the request head, and then the body, so idle clients can't hold a slot
+        self.queue = None
+        self.clients = None
+        self.activeJob = None
+        self.jobs = OrderedDict() # job id -> PrintJob
+
+    async def serve(self):
+        self.queue = asyncio.Queue(self.queueSize)
+        self.clients = asyncio.Semaphore(self.maxClients)
+        await self.printer.connect()
+        print(self.printer)
+        worker = asyncio.create_task(self.print_worker())
+        if self.telemetry:
+            self.telemetry.start()
+        server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        print("Serving print API on http://%s:%i" % (self.host, self.port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            worker.cancel()
+            if self.telemetry:
+                self.telemetry.stop()
+            await self.printer.disconnect()
+
+    async def print_worker(self):
+        while True:
+            job = await self.queue.get()
+            job.state = 'printing'
+            self.activeJob = job
+            try:
+                job.printerStatus = await self.printer.print_image(job.imagePath)
+                if job.printerStatus == PrinterResults.NORMAL_TERMINATION:
+                    job.state = 'done'
+                else:
+                    job.state = 'failed'
+                    job.error = 'Image rejected by printer requirements' if job.printerStatus is None else 'Printer reported %s' % job.printerStatus.name
+            except Exception as e:
+                job.state = 'failed'
+                job.error = str(e)
+            finally:
+                self.activeJob = None
+                os.remove(job.imagePath)
+                self.queue.task_done()
+
+    def add_job(self, job):
+        self.jobs[job.id] = job
+        while len(self.jobs) > self.historySize:
+            oldest = next(iter(self.jobs.values()))
+            if oldest.state in ('queued', 'printing'):
+                break
+            self.jobs.popitem(last = False)
+
+    async def handle_client(self, reader, writer):
+        async with self.clients:
+            try:
+                requestLine, headers = await asyncio.wait_for(self.read_head(reader), self.readTimeout)
+                if len(requestLine) != 3:
+                    await self.send_response(writer, 400, {'error': 'Malformed request line'})
+                else:
+                    await self.route(reader, writer, requestLine[0], requestLine[1], headers)
+            except asyncio.TimeoutError:
+                await self.send_response(writer, 408, {'error': 'Request not received within %g seconds' % self.readTimeout})
+            except Exception as e:
+                await self.send_response(writer, 500, {'error': str(e)})
+            finally:
+                writer.close()
+                await writer.wait_closed()
+
+    async def read_head(self, reader):
+        requestLine = (await reader.readline()).decode('latin-1').split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return requestLine, headers
+
+    async def route(self, reader, writer, method, path, headers):
+        if method == 'POST' and path == '/print':
+            await self.handle_print(reader, writer, headers)
+        elif method == 'GET' and path == '/status':
+            await self.send_response(writer, 200, await self.get_status())
+        elif method == 'GET' and path == '/telemetry' and self.telemetry:
+            await self.send_response(writer, 200, {'stats': self.telemetry.stats(), 'samples': [sample.to_dict() for sample in self.telemetry.samples]})
+        elif method == 'GET' and path == '/jobs':
+            await self.send_response(writer, 200, [job.to_dict() for job in self.jobs.values()])
+        elif method == 'GET' and path.startswith('/jobs/') and path[6:] in self.jobs:
+            await self.send_response(writer, 200, self.jobs[path[6:]].to_dict())
+        else:
+            await self.send_response(writer, 404, {'error': 'Not found'})
+
+    async def handle_print(self, reader, writer, headers):
+        if 'content-length' not in headers:
+            await self.send_response(writer, 411, {'error': 'Content-Length required'})
+            return
+        try:
+            size = int(headers['content-length'])
+        except ValueError:
+            await self.send_response(writer, 400, {'error': 'Invalid Content-Length %s' % headers['content-length']})
+            return
+        if size <= 0 or size > self.printer.maxImageSize:
+            await self.send_response(writer, 413, {'error': 'Image must be at most %i bytes' % self.printer.maxImageSize})
+            return
+        if self.queue.full():
+            await self.send_response(writer, 503, {'error': 'Print queue is full'})
+            return
+        # the body is spooled to disk chunk by chunk and handed to the printer by path, it is never held in memory as a whole
+        fd, imagePath = tempfile.mkstemp(prefix = 'instax-', suffix = '.jpg')
+        try:
+            with os.fdopen(fd, 'wb') as spool:
+                await asyncio.wait_for(self.spool_body(reader, spool, size), self.readTimeout)
+            if not self.printer.check_image(imagePath):
+                raise ValueError("It must be a JPG file with height %i, width %i and maximum size %i KB" % (self.printer.imageHeight, self.printer.imageWidth, self.printer.maxImageSize))
+            job = PrintJob(imagePath, size)
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            os.remove(imagePath)
+            await self.send_response(writer, 503, {'error': 'Print queue is full'})
+            return
+        except asyncio.TimeoutError:
+            os.remove(imagePath)
+            await self.send_response(writer, 408, {'error': 'Image not received within %g seconds' % self.readTimeout})
+            return
+        except Exception as e:
+            os.remove(imagePath)
+            await self.send_response(writer, 400, {'error': 'The provided image cannot be printed! %s' % e})
+            return
+        self.add_job(job)
+        await self.send_response(writer, 202, job.to_dict())
+
+    async def spool_body(self, reader, spool, size):
+        remaining = size
+        while remaining > 0:
+            chunk = await reader.read(min(self.chunkSize, remaining))
+            if not chunk:
+                raise Exception('Upload truncated')
+            spool.write(chunk)
+            remaining -= len(chunk)
+
+    async def get_status(self):
+        # the query waits behind image frames and is coalesced with the status polling of a running job
+        self.printer.set_function_info(await self.printer.connection.request_function_info_printer_function())
+        return {'model': self.printer.model, 'serial': self.printer.serial, 'batteryLevel': self.printer.batteryLevel, 'remainingPictures': self.printer.remainingPictures, 'printerStatus': self.printer.printerStatus.name, 'busy': self.activeJob is not None, 'queued': self.queue.qsize()}
+
+    async def send_response(self, writer, status, body):
+        content = json.dumps(body).encode()
+        writer.write(b'HTTP/1.1 %i %s\r\nContent-Type: application/json\r\nContent-Length: %i\r\nConnection: close\r\n\r\n' % (status, HTTPStatus(status).phrase.encode(), len(content)) + content)
+        await writer.drain()
 
 # main
 
+def write_profile_report(instax, path = None): # InstaxPrinter, path of the JSON report, None prints it
+    report = {'device': instax.connection.device_name, 'model': instax.model, 'serial': instax.serial, 'status': instax.printerStatus.name}
+    report.update(instax.profiler.to_dict())
+    instax.profiler.print_breakdown()
+    if path:
+        with open(path, 'w') as file:
+            json.dump(report, file, indent = 2)
+        print("Profile report written to %s" % path)
+    else:
+        print(json.dumps(report))
+
 async def main(args={}):
     try:
-        instax = InstaxPrinter(**args)
-        await instax.connect()
-        print(instax)
-        await instax.print_image()
-        await instax.disconnect()
+        args = dict(args)
+        port = args.pop('serve', None)
+        serverArgs = {'host': args.pop('host', '127.0.0.1'), 'queue_size': args.pop('queue_size', 8), 'max_clients': args.pop('max_clients', 4), 'telemetry_interval': args.pop('telemetry_interval', 0), 'telemetry_size': args.pop('telemetry_size', 120), 'read_timeout': args.pop('read_timeout', 30.0)}
+        status = args.pop('status', False)
+        fleetArgs = {'concurrency': args.pop('concurrency', 4), 'timeout': args.pop('status_timeout', 60.0)}
+        jsonOutput = args.pop('json', False)
+        profile = args.pop('profile', False)
+        profileCpu = args.pop('profile_cpu', False)
+        profileReport = args.pop('profile_report', None)
+        if (profile or profileCpu or profileReport) and (status or port):
+            # the profiler times a single print, not a server or a fleet of printers
+            raise Exception("--profile, --profile-cpu and --profile-report can't be used with --serve or --status")
+        if status:
+            fleet = InstaxFleet(command_timeout = args.get('command_timeout', 10.0), retries = args.get('retries'), debug = args.get('debug', False), **fleetArgs)
+            # connection progress goes to stderr, so that the snapshot alone can be piped
+            with redirect_stdout(sys.stderr):
+                statuses = await fleet.status()
+            print(json.dumps(statuses) if jsonOutput else fleet.format_table(statuses))
+            return
+        instax = InstaxPrinter(**args, profiler = PhaseProfiler(profileCpu))
+        if port:
+            await InstaxPrintServer(instax, port = port, **serverArgs).serve()
+            return
+        instax.profiler.start()
+        try:
+            await instax.connect()
+            print(instax)
+            await instax.print_image()
+            await instax.disconnect()
+        finally:
+            instax.profiler.stop()
+            if profile or profileCpu or profileReport:
+                write_profile_report(instax, profileReport)
     except Exception as e:
         print(e)
 
@@ -955,7 +1979,26 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description = "Utility to print a JPG image to an InstaxLink printer")
     parser.add_argument('-n', '--device-name', help = 'Device name, format INSTAX-xxxxxxxx(IOS) or INSTAX-xxxxxxxx(ANDROID)') # INSTAX-20189264(IOS)
     parser.add_argument('-i', '--image-path', help = 'Path to the image file')
+    parser.add_argument('-l', '--lut', dest = 'lut_path', help = 'Path to a .cube 3D LUT applied to the image before printing (requires numpy)')
+    parser.add_argument('--head-reference', type = lambda value: tuple(int(intensity) for intensity in value.split(',')), metavar = 'R,G,B', help = 'Compensate the image for the calibrated head intensities of the printer, scaling them to these reference intensities')
+    parser.add_argument('--command-timeout', type = float, default = 10.0, metavar = 'SECONDS', help = 'Deadline for the printer to answer a single command')
+    parser.add_argument('--job-timeout', type = float, default = 300.0, metavar = 'SECONDS', help = 'Deadline for a whole print job, after which the transfer is cancelled')
+    parser.add_argument('--retry', dest = 'retries', action = 'append', type = lambda value: (ResultCode[value.split('=')[0]], int(value.split('=')[1])), metavar = 'RESULT_CODE=N', help = 'Retry commands failing with RESULT_CODE up to N times, e.g. PRINTER_BUSY=10 (PRINTER_BUSY and CAMERA_BUSY are retried 5 times by default)')
     parser.add_argument('-d', '--debug', action = 'store_true')
+    parser.add_argument('--status', action = 'store_true', help = 'Find all Instax Link printers in a single scan and show model, serial, film, battery and status of each')
+    parser.add_argument('--concurrency', type = int, default = 4, help = 'Maximum number of printers connected at the same time by --status')
+    parser.add_argument('--status-timeout', type = float, default = 60.0, metavar = 'SECONDS', help = 'Deadline for --status, scan included, printers not answering by then are reported as such')
+    parser.add_argument('--json', action = 'store_true', help = 'Print the --status snapshot as JSON instead of a table')
+    parser.add_argument('--profile', action = 'store_true', help = 'Time discovery, connection, queries, image transfer and status polling and print a breakdown and a JSON report')
+    parser.add_argument('--profile-cpu', action = 'store_true', help = 'Also profile the host CPU time with cProfile, implies --profile')
+    parser.add_argument('--profile-report', metavar = 'REPORT_PATH', help = 'Write the JSON profile report to REPORT_PATH instead of printing it, implies --profile')
+    parser.add_argument('-s', '--serve', type = int, metavar = 'PORT', help = 'Keep the printer connected and serve the HTTP print API on PORT')
+    parser.add_argument('--host', default = '127.0.0.1', help = 'Address the HTTP print API binds to')
+    parser.add_argument('--queue-size', type = int, default = 8, help = 'Maximum number of print jobs waiting in the queue')
+    parser.add_argument('--read-timeout', type = float, default = 30.0, metavar = 'SECONDS', help = 'Deadline to receive the head and then the body of an HTTP request, idle connections are closed after it')
+    parser.add_argument('--max-clients', type = int, default = 4, help = 'Maximum number of HTTP requests handled concurrently')
+    parser.add_argument('--telemetry-interval', type = float, default = 0, metavar = 'SECONDS', help = 'Sample battery voltage, temperature, battery and print history every SECONDS between print jobs, 0 disables it')
+    parser.add_argument('--telemetry-size', type = int, default = 120, help = 'Number of telemetry samples kept')
     args = parser.parse_args()
 
     asyncio.run(main(vars(args)))
\ No newline at end of file
@@ -0,0 +1,60 @@
+import sys
+import os
+import argparse
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from InstaxLink import *
+
+# Classes built for every received message, a __dict__ on any of them multiplies the memory of each status poll
+messageClasses = [InboundMessage, OutboundMessage, Response, SupportFunctionInfoResponse, PrinterFunctionInfo, ImageSupportInfo, BatteryInfo, PrintHistoryInfo,
+                  AdditionalPrinterInfoResponse, VoltageInfo, ColorInfo, DeviceInfoResponse, SupportFunctionaAndVersionInfoResponse, AutoSleepSettingsResponse,
+                  ImageTransferStartResponse, ImageFrameTransferResponse, ImagePrintResponse, LightCorrectInfoResponse]
+
+def status_payload():
+    # the printer function info polled while a print is processing
+    return InboundMessage.build(SID.SUPPORT_FUNCTION_INFO, ResultCode.OK, pack('>BBBBBI', SupportFunctionInfoType.PRINTER_FUNCTION_INFO.value, 0x5a, 0, PrinterResults.NORMAL_TERMINATION.value, 0, 0)).payload
+
+def poll(payload):
+    response = Response(payload)
+    if response.valid:
+        info = SupportFunctionInfoResponse(response.message.data).info
+        return info.filmRemain, info.batteryRemain, info.resultPrintRequest
+
+def check_slots():
+    # a class in the hierarchy without __slots__ adds the __dict__ descriptor
+    return ['%s instances have a __dict__' % messageClass.__name__ for messageClass in messageClasses if any('__dict__' in vars(base) for base in messageClass.__mro__)]
+
+def retained_bytes(number):
+    # bytes still allocated per poll while the responses are kept, as a caller holding the last status would
+    payload = status_payload()
+    responses = []
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(number):
+        response = Response(payload)
+        responses.append((response, SupportFunctionInfoResponse(response.message.data)))
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    return sum(statistic.size_diff for statistic in after.compare_to(before, 'filename')) / number
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Memory retained and time taken by decoding a printer status poll")
+    parser.add_argument('--number', type = int, default = 20000, help = 'Polls decoded')
+    parser.add_argument('--repeat', type = int, default = 5)
+    parser.add_argument('--max-bytes', type = float, default = 320, help = 'Allowed retained bytes per poll, 606 before the messages used __slots__')
+    args = parser.parse_args()
+
+    errors = check_slots()
+    for error in errors:
+        print(error)
+    bytesPerPoll = retained_bytes(args.number)
+    payload = status_payload()
+    timePerPoll = min(timeit.repeat(lambda: poll(payload), number = args.number, repeat = args.repeat)) / args.number * 1e6
+    print("Retained %.0f bytes per poll, %.2f us per poll" % (bytesPerPoll, timePerPoll))
+    if bytesPerPoll > args.max_bytes:
+        errors.append("retained bytes per poll above %g" % args.max_bytes)
+        print("Retained bytes per poll above %g" % args.max_bytes)
+    if errors:
+        sys.exit(1)
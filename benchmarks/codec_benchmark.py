@@ -0,0 +1,263 @@
+import sys
+import os
+import io
+import json
+import random
+import argparse
+import timeit
+from contextlib import redirect_stdout
+from struct import pack
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from InstaxLink import *
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'codec_baseline.json')
+
+# Random messages, every generator returns the message and the values expected after decoding
+
+def random_text(rng, maxLength):
+    return ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789.-') for i in range(rng.randint(0, maxLength)))
+
+def version_info(rng):
+    values = [rng.randint(0, 255) for i in range(8)]
+    return pack('>8B', *values), dict(zip(SupportFunctionaAndVersionInfoResponse.__slots__, values))
+
+def device_info(rng):
+    type = rng.choice(list(DeviceInfoType))
+    value = random_text(rng, 32)
+    return pack('>BB', type.value, len(value)) + value.encode(), {'type': type, 'value': value}
+
+def image_support_info(rng):
+    width, height, picType, picOption, size = rng.randint(0, 65535), rng.randint(0, 65535), rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 2 ** 32 - 1)
+    return pack('>BHHBBI', SupportFunctionInfoType.IMAGE_SUPPORT_INFO.value, width, height, picType, picOption, size), {'info.width': width, 'info.height': height, 'info.picType': picType, 'info.picOption': picOption, 'info.size': size, 'info.is3DLutAvailable()': bool(picOption & 8)}
+
+def battery_info(rng):
+    batteryLevel, batteryCapacity, chargerType, chargerState = [rng.randint(0, 255) for i in range(4)]
+    return pack('>BBBBB', SupportFunctionInfoType.BATTERY_INFO.value, batteryLevel, batteryCapacity, chargerType, chargerState), {'info.batteryLevel': batteryLevel, 'info.batteryCapacity': batteryCapacity, 'info.chargerType': chargerType, 'info.chargerState': chargerState}
+
+def printer_function_info(rng):
+    filmData, statusData, printWaitTime, errorData = rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 2 ** 32 - 1)
+    result = rng.choice([result for result in PrinterResults if result.value >= 0])
+    return pack('>BBBBBI', SupportFunctionInfoType.PRINTER_FUNCTION_INFO.value, filmData, statusData, result.value, printWaitTime, errorData), {'info.filmRemain': filmData & 15, 'info.batteryRemain': (filmData >> 4) & 7, 'info.chargeFlg': bool(filmData & 128), 'info.backCoverState': bool(statusData & 1), 'info.printerOperationFlg': bool(statusData & 2), 'info.printerErrFlg': bool(statusData & 4), 'info.printerOperationInfo': statusData >> 4, 'info.printWaitTime': printWaitTime, 'info.printerErrType': errorData, 'info.resultPrintRequest': result}
+
+def print_history_info(rng):
+    totalPrintNum, totalEjectFCNum = rng.randint(0, 2 ** 32 - 1), rng.randint(0, 2 ** 32 - 1)
+    return pack('>BII', SupportFunctionInfoType.PRINT_HISTORY_INFO.value, totalPrintNum, totalEjectFCNum), {'info.totalPrintNum': totalPrintNum, 'info.totalEjectFCNum': totalEjectFCNum}
+
+def voltage_info(rng):
+    batteryVoltage, printerTemperature = rng.randint(0, 65535), rng.randint(0, 65535)
+    return pack('>BHH', AdditionalPrinterInfoType.VOLTAGE_INFO.value, batteryVoltage, printerTemperature), {'info.batteryVoltage': batteryVoltage, 'info.printerTemperature': printerTemperature}
+
+def color_info(rng):
+    totalNumberOfPrintAttempts, batteryType, withOrWithoutFilmPI = rng.randint(0, 2 ** 32 - 1), rng.randint(0, 255), rng.randint(0, 255)
+    color = rng.choice([color for color in CameraColor if color.value >= 0])
+    return pack('>BIBBB', AdditionalPrinterInfoType.COLOR_INFO.value, totalNumberOfPrintAttempts, batteryType, color.value, withOrWithoutFilmPI), {'info.totalNumberOfPrintAttempts': totalNumberOfPrintAttempts, 'info.batteryType': batteryType, 'info.colorVariationInformation': color, 'info.withOrWithoutFilmPI': withOrWithoutFilmPI}
+
+def light_correct_info(rng):
+    headType = rng.choice([headType for headType in PrinterMountedHeadType if headType.value >= 0])
+    flag, year, month, day, r, g, b = rng.randint(0, 255), rng.randint(0, 65535), rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 65535), rng.randint(0, 65535), rng.randint(0, 65535)
+    return pack('>BBBHBBHHH', headType.value, flag, 0, year, month, day, r, g, b), {'printerHeadType': headType, 'printingDateJudgeFlag': flag, 'year': year, 'month': month, 'day': day, 'rIntensity': r, 'gIntensity': g, 'bIntensity': b}
+
+def auto_sleep_settings(rng):
+    times = [rng.randint(0, 65535) for i in range(4)]
+    return pack('>HHHH', *times), dict(zip(AutoSleepSettingsResponse.__slots__, times))
+
+def unsigned_int(field):
+    def generate(rng):
+        value = rng.randint(0, 2 ** 32 - 1)
+        return pack('>I', value), {field: value}
+    return generate
+
+def empty(rng):
+    # acknowledgements without data, parse_response returns None for them
+    return b'', None
+
+def image_print(rng):
+    endTime = rng.randint(0, 255)
+    return pack('>B', endTime), {'endTime': endTime}
+
+responseCases = [
+    ('SUPPORT_FUNCTION_AND_VERSION_INFO', SID.SUPPORT_FUNCTION_AND_VERSION_INFO, version_info),
+    ('DEVICE_INFO_SERVICE', SID.DEVICE_INFO_SERVICE, device_info),
+    ('SUPPORT_FUNCTION_INFO IMAGE_SUPPORT_INFO', SID.SUPPORT_FUNCTION_INFO, image_support_info),
+    ('SUPPORT_FUNCTION_INFO BATTERY_INFO', SID.SUPPORT_FUNCTION_INFO, battery_info),
+    ('SUPPORT_FUNCTION_INFO PRINTER_FUNCTION_INFO', SID.SUPPORT_FUNCTION_INFO, printer_function_info),
+    ('SUPPORT_FUNCTION_INFO PRINT_HISTORY_INFO', SID.SUPPORT_FUNCTION_INFO, print_history_info),
+    ('ADDITIONAL_PRINTER_INFO VOLTAGE_INFO', SID.ADDITIONAL_PRINTER_INFO, voltage_info),
+    ('ADDITIONAL_PRINTER_INFO COLOR_INFO', SID.ADDITIONAL_PRINTER_INFO, color_info),
+    ('PRINTER_HEAD_LIGHT_CORRECT_INFO', SID.PRINTER_HEAD_LIGHT_CORRECT_INFO, light_correct_info),
+    ('AUTO_SLEEP_SETTINGS', SID.AUTO_SLEEP_SETTINGS, auto_sleep_settings),
+    ('PRINT_IMAGE_DOWNLOAD_START', SID.PRINT_IMAGE_DOWNLOAD_START, unsigned_int('frameSize')),
+    ('PRINT_IMAGE_DOWNLOAD_DATA', SID.PRINT_IMAGE_DOWNLOAD_DATA, unsigned_int('frameNumber')),
+    ('PRINT_IMAGE_DOWNLOAD_END', SID.PRINT_IMAGE_DOWNLOAD_END, empty),
+    ('PRINT_IMAGE_DOWNLOAD_CANCEL', SID.PRINT_IMAGE_DOWNLOAD_CANCEL, empty),
+    ('FW_DOWNLOAD_START', SID.FW_DOWNLOAD_START, unsigned_int('frameSize')),
+    ('FW_DOWNLOAD_DATA', SID.FW_DOWNLOAD_DATA, unsigned_int('frameNumber')),
+    ('FW_DOWNLOAD_END', SID.FW_DOWNLOAD_END, empty),
+    ('FRAME_PICTURE_DOWNLOAD_START', SID.FRAME_PICTURE_DOWNLOAD_START, unsigned_int('frameSize')),
+    ('FRAME_PICTURE_DOWNLOAD', SID.FRAME_PICTURE_DOWNLOAD, unsigned_int('frameNumber')),
+    ('FRAME_PICTURE_DOWNLOAD_END', SID.FRAME_PICTURE_DOWNLOAD_END, empty),
+    ('PRINT_IMAGE', SID.PRINT_IMAGE, image_print),
+]
+
+requestCases = [
+    ('SUPPORT_FUNCTION_AND_VERSION_INFO', lambda rng: SupportFunctionaAndVersionInfoRequest()),
+    ('DEVICE_INFO_SERVICE', lambda rng: DeviceInfoRequest(rng.choice(list(DeviceInfoType)))),
+    ('SUPPORT_FUNCTION_INFO', lambda rng: SupportFunctionInfoRequest(rng.choice(list(SupportFunctionInfoType)))),
+    ('ADDITIONAL_PRINTER_INFO', lambda rng: AdditionalPrinterInfoRequest(rng.choice(list(AdditionalPrinterInfoType)))),
+    ('AUTO_SLEEP_SETTINGS', lambda rng: AutoSleepSettingsRequest(rng.choice(list(AutoSleepSettingsMode)), *[rng.randint(0, 65535) for i in range(4)])),
+    ('PRINT_IMAGE_DOWNLOAD_START', lambda rng: ImageTransferStartRequest(PictureType.PICINF_PICTYPE_JPEG, rng.choice(list(PicturePrintOption)), rng.randint(0, 2 ** 32 - 1))),
+    ('PRINT_IMAGE_DOWNLOAD_DATA', lambda rng: ImageFrameTransferRequest(rng.randint(0, 2 ** 32 - 1), rng.randbytes(900))),
+    ('PRINT_IMAGE_DOWNLOAD_END', lambda rng: ImageTransferEndRequest()),
+    ('PRINT_IMAGE_DOWNLOAD_CANCEL', lambda rng: ImageTransferCancelRequest()),
+    ('FW_DOWNLOAD_START', lambda rng: UploadStartRequest(BulkUploadType.FIRMWARE, rng.randint(0, 2 ** 32 - 1))),
+    ('FW_DOWNLOAD_DATA', lambda rng: UploadFrameRequest(BulkUploadType.FIRMWARE, rng.randint(0, 2 ** 32 - 1), rng.randbytes(900))),
+    ('FW_DOWNLOAD_END', lambda rng: UploadEndRequest(BulkUploadType.FIRMWARE)),
+    ('FRAME_PICTURE_DOWNLOAD_START', lambda rng: UploadStartRequest(BulkUploadType.FRAME_PICTURE, rng.randint(0, 2 ** 32 - 1))),
+    ('FRAME_PICTURE_DOWNLOAD', lambda rng: UploadFrameRequest(BulkUploadType.FRAME_PICTURE, rng.randint(0, 2 ** 32 - 1), rng.randbytes(900))),
+    ('FRAME_PICTURE_DOWNLOAD_END', lambda rng: UploadEndRequest(BulkUploadType.FRAME_PICTURE)),
+    ('PRINT_IMAGE', lambda rng: ImagePrintRequest()),
+    ('PRINTER_HEAD_LIGHT_CORRECT_INFO', lambda rng: LightCorrectInfoRequest()),
+]
+
+# Round trip and corruption checks
+
+def resolve(response, path):
+    value = response
+    for name in path.split('.'):
+        value = getattr(value, name[:-2])() if name.endswith('()') else getattr(value, name)
+    return value
+
+def check_request(name, request):
+    payload = request.message.get_payload()
+    errors = []
+    if payload[:2] != b'\x41\x62':
+        errors.append('signature %s' % payload[:2].hex())
+    if int.from_bytes(payload[2:4], 'big') != len(payload):
+        errors.append('size %i for %i bytes' % (int.from_bytes(payload[2:4], 'big'), len(payload)))
+    if (payload[4], payload[5]) != request.message.sid.value:
+        errors.append('SID %i %i' % (payload[4], payload[5]))
+    if payload[6:-1] != request.message.data:
+        errors.append('data')
+    if (sum(payload[:-1]) + payload[-1]) & 255 != 255:
+        errors.append('checksum')
+    return ['request %s: %s' % (name, error) for error in errors]
+
+def check_response(name, sid, data, expected, connection):
+    errors = []
+    payload = InboundMessage.build(sid, ResultCode.OK, data).payload
+    response = connection.parse_response(payload)
+    if expected is None:
+        return [] if response is None and Response(payload).valid else ['response %s: %r, expected an accepted acknowledgement' % (name, response)]
+    if response is None:
+        return ['response %s: rejected' % name]
+    for path, value in expected.items():
+        if resolve(response, path) != value:
+            errors.append('response %s: %s is %r, expected %r' % (name, path, resolve(response, path), value))
+    return errors
+
+def check_corruption(name, sid, data, rng, debugConnection):
+    payload = bytearray(InboundMessage.build(sid, ResultCode.OK, data).payload)
+    position = rng.randrange(len(payload))
+    payload[position] ^= 1 << rng.randrange(8)
+    truncated = bytes(payload[:rng.randrange(len(payload))])
+    errors = []
+    for corrupted in (bytes(payload), truncated, b''):
+        try:
+            if Response(corrupted).valid:
+                errors.append('response %s: corrupted payload %s accepted' % (name, corrupted.hex()))
+            # with debug the response is printed before it's validated
+            elif debugConnection.parse_response(corrupted) is not None:
+                errors.append('response %s: corrupted payload %s decoded' % (name, corrupted.hex()))
+        except Exception as e:
+            errors.append('response %s: corrupted payload %s raised %r' % (name, corrupted.hex(), e))
+    return errors
+
+def run_checks(iterations, seed):
+    rng = random.Random(seed)
+    connection = InstaxConnection('INSTAX-BENCHMARK')
+    debugConnection = InstaxConnection('INSTAX-BENCHMARK', debug = True)
+    errors = []
+    with redirect_stdout(io.StringIO()): # Response.validate reports every rejected payload
+        for i in range(iterations):
+            for name, factory in requestCases:
+                errors += check_request(name, factory(rng))
+            for name, sid, generate in responseCases:
+                data, expected = generate(rng)
+                errors += check_response(name, sid, data, expected, connection)
+                errors += check_corruption(name, sid, data, rng, debugConnection)
+    return errors
+
+# Benchmark
+
+def encode(sid, data):
+    return lambda: OutboundMessage(sid, data).get_payload()
+
+def decode(connection, payload):
+    return lambda: connection.parse_response(payload)
+
+def run_benchmark(repeat, number):
+    rng = random.Random(0)
+    connection = InstaxConnection('INSTAX-BENCHMARK')
+    timers = OrderedDict()
+    for name, factory in requestCases:
+        request = factory(rng)
+        timers['encode ' + name] = timeit.Timer(encode(request.message.sid, request.message.data))
+    for name, sid, generate in responseCases:
+        timers['decode ' + name] = timeit.Timer(decode(connection, InboundMessage.build(sid, ResultCode.OK, generate(rng)[0]).payload))
+    for timer in timers.values(): # warm up, so the first cases aren't timed before the CPU clocks up
+        timer.timeit(number)
+    # every round times each case once, a slow stretch of the machine then costs one round of every case instead of all rounds of a few
+    results = dict((name, float('inf')) for name in timers)
+    for round in range(repeat):
+        for name, timer in timers.items():
+            results[name] = min(results[name], timer.timeit(number) / number * 1e9)
+    return results # nanoseconds per operation
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, value in results.items():
+        reference = baseline.get(name)
+        change = '' if reference is None else '%+6.1f%%' % ((value / reference - 1) * 100)
+        print('%-60s %9.0f ns %s' % (name, value, change))
+        if reference is not None and value > reference * (1 + threshold):
+            regressions.append(name)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Codec round trip checks and microbenchmark for InstaxLink")
+    parser.add_argument('--iterations', type = int, default = 200, help = 'Randomized round trip and corruption iterations per SID')
+    parser.add_argument('--seed', type = int, default = None, help = 'Seed of the randomized checks, random if omitted')
+    parser.add_argument('--repeat', type = int, default = 15)
+    parser.add_argument('--number', type = int, default = 5000)
+    parser.add_argument('--threshold', type = float, default = 0.25, help = 'Allowed slowdown against the baseline, 0.25 is 25%%')
+    parser.add_argument('--baseline', default = BASELINE_PATH, help = 'Path to the baseline of this machine, created by the first run')
+    parser.add_argument('--update-baseline', action = 'store_true', help = 'Store the results as the new baseline')
+    parser.add_argument('--skip-benchmark', action = 'store_true')
+    args = parser.parse_args()
+
+    seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+    errors = run_checks(args.iterations, seed)
+    for error in errors[:20]:
+        print(error)
+    print("Round trip and corruption checks with seed %i: %s" % (seed, "%i failures" % len(errors) if errors else "OK"))
+    if errors:
+        sys.exit(1)
+    if args.skip_benchmark:
+        sys.exit(0)
+
+    results = run_benchmark(args.repeat, args.number)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    regressions = compare(results, baseline, args.threshold)
+    if args.update_baseline or not baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump({name: round(value) for name, value in results.items()}, file, indent = 2)
+            file.write('\n')
+        print("Baseline stored in %s" % args.baseline)
+    elif regressions:
+        print("Slower than the baseline by more than %i%%: %s" % (args.threshold * 100, ', '.join(regressions)))
+        sys.exit(1)
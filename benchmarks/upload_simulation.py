@@ -0,0 +1,98 @@
+import sys
+import os
+import io
+import random
+import argparse
+import asyncio
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from InstaxLink import *
+
+def start_request(uploadType, buffer):
+    if uploadType == BulkUploadType.PRINT_IMAGE:
+        return ImageTransferStartRequest(PictureType.PICINF_PICTYPE_JPEG, PicturePrintOption.PICINF_PICOP_NONE, len(buffer))
+    return None # the generic start request of the upload type
+
+def count_frames(connection):
+    # counts the frames put on the wire, resent ones included, and those the printer got out of sequence
+    sent = {'frames': 0, 'outOfSequence': 0}
+    frameSIDs = [uploadType.value[1] for uploadType in BulkUploadType]
+    execute = connection.execute
+    def counting_execute(sid, data):
+        resultCode, response = execute(sid, data)
+        if sid in frameSIDs:
+            sent['frames'] += 1
+            if resultCode == ResultCode.SEQUENCE_ERROR:
+                sent['outOfSequence'] += 1
+        return resultCode, response
+    connection.execute = counting_execute
+    return sent
+
+async def check_uploads(rng, sizes, failureRate, frameSize, window, retries):
+    errors = []
+    for uploadType in BulkUploadType:
+        for size in sizes:
+            connection = InstaxSimulatorConnection(frame_size = frameSize, failure_rate = failureRate, seed = rng.randrange(2 ** 32))
+            sent = count_frames(connection)
+            buffer = rng.randbytes(size)
+            try:
+                numberOfFrames = await BulkUploader(connection, window, retries).upload(uploadType, buffer, start_request(uploadType, buffer))
+            except Exception as e:
+                errors.append('%s of %i bytes failed: %s' % (uploadType.name, size, e))
+                continue
+            finally:
+                await connection.disconnect()
+            if connection.uploads.get(uploadType) != buffer:
+                errors.append('%s of %i bytes differs from the data sent' % (uploadType.name, size))
+            if sent['outOfSequence']:
+                errors.append('%s of %i bytes sent %i frames out of sequence after failures' % (uploadType.name, size, sent['outOfSequence']))
+            print("%-14s %8i bytes %5i frames %5i sent" % (uploadType.name, size, numberOfFrames, sent['frames']), file = sys.stderr)
+    return errors
+
+async def check_give_up(rng, frameSize, window, retries):
+    # every frame response is garbled, the uploader has to give up after the retries and the upload must not complete
+    errors = []
+    for uploadType in BulkUploadType:
+        connection = InstaxSimulatorConnection(frame_size = frameSize, failure_rate = 1.0, seed = rng.randrange(2 ** 32))
+        sent = count_frames(connection)
+        buffer = rng.randbytes(frameSize * 3)
+        try:
+            await BulkUploader(connection, window, retries).upload(uploadType, buffer, start_request(uploadType, buffer))
+            errors.append('%s completed although every frame failed' % uploadType.name)
+        except Exception as e:
+            if not str(e).startswith('Failed to transfer frame number 1 of 3'):
+                errors.append('%s failed with an unexpected error: %s' % (uploadType.name, e))
+        finally:
+            await connection.disconnect()
+        if uploadType in connection.uploads:
+            errors.append('%s stored by the printer although the upload failed' % uploadType.name)
+        if sent['frames'] > (retries + 1) * window:
+            errors.append('%s sent %i frames, more than %i retries allow' % (uploadType.name, sent['frames'], retries))
+    return errors
+
+async def run(seed, failureRate, frameSize, window, retries):
+    rng = random.Random(seed)
+    # a single byte, shorter than a frame, exact multiples of the frame size, one byte over and a full size print
+    sizes = [1, frameSize - 1, frameSize, frameSize + 1, frameSize * 7, rng.randint(1, 337920)]
+    with redirect_stdout(io.StringIO()): # the uploader reports every failed frame
+        errors = await check_uploads(rng, sizes, failureRate, frameSize, window, retries)
+        errors += await check_give_up(rng, frameSize, window, retries)
+    return errors
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Uploads print images, firmware and frame pictures to the simulated printer with injected failures")
+    parser.add_argument('--seed', type = int, default = None, help = 'Seed of the data and of the injected failures, random if omitted')
+    parser.add_argument('--failure-rate', type = float, default = 0.1, help = 'Probability of garbling the response to a frame')
+    parser.add_argument('--frame-size', type = int, default = 900)
+    parser.add_argument('--window', type = int, default = 2, help = 'Frames queued ahead of the acknowledged one')
+    parser.add_argument('--retries', type = int, default = 6, help = 'Consecutive failures tolerated for a frame, enough for the default failure rate to never exhaust them')
+    args = parser.parse_args()
+
+    seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+    errors = asyncio.run(run(seed, args.failure_rate, args.frame_size, args.window, args.retries))
+    for error in errors:
+        print(error)
+    print("Upload simulation with seed %i: %s" % (seed, "%i failures" % len(errors) if errors else "OK"))
+    if errors:
+        sys.exit(1)